@@ -1,15 +1,38 @@
 from flask import Flask, render_template_string, request, session, redirect, url_for, jsonify, has_request_context
+from flask_session import Session
+from cachelib.file import FileSystemCache
 import pandas as pd
-import google.generativeai as genai
+import numpy as np
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
 import threading
 import webbrowser
 import os
 import io
 import json
 import re
-from flask import send_file
+import shlex
+import bisect
+import csv
+import heapq
+import functools
+import uuid
+import sys
+import time
+import hashlib
+import argparse
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from flask import Response
+import zlib
 from datetime import datetime
 import shutil
+import sqlite3
+from contextlib import closing
+import urllib.request
+import urllib.error
+import random
+from html import escape
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -20,8 +43,13 @@ app.config['PROPAGATE_EXCEPTIONS'] = True
 # Global variables
 DEFAULT_CSV_PATH = r""  # Set a default CSV path if needed
 UPLOAD_FOLDER = 'uploads'  # Directory to store uploaded CSV files
+SESSION_FOLDER = 'flask_session'  # Directory for server-side session data
+TABLE_CACHE_FOLDER = 'table_cache'  # Memory-mapped Arrow copies of loaded CSVs
+AI_CACHE_FOLDER = 'ai_cache'  # Cached AI answers (see ai_cache_key)
 SETTINGS_FILE = 'settings.json'  # File to store persistent settings
-CHAT_HISTORY_FILE = 'chat_history.json'  # File to store chat history
+CHAT_HISTORY_FILE = 'chat_history.json'  # Old JSON chat history, imported into CHAT_DB_FILE
+CHAT_DB_FILE = 'chat_history.db'  # SQLite chat history
+CHAT_PAGE_SIZE = 20  # Chat entries per sidebar page
 CHUNK_SIZE = 10000  # For chunk-based searching (unused now)
 DEFAULT_ROWS_PER_PAGE = 10  # Default for pagination
 # Removed DEFAULT_SEARCH_COLUMN as search is now across all columns
@@ -29,30 +57,723 @@ DEFAULT_ROWS_PER_PAGE = 10  # Default for pagination
 # Global cache to optimize file I/O and parsing
 csv_cache = {}
 
+# Locks for state shared between request threads. csv_cache_lock guards the
+# cached table and everything derived from it; csv_loading holds an Event per
+# table being parsed so concurrent requests wait for one read_csv
+csv_cache_lock = threading.RLock()
+csv_index_lock = threading.Lock()
+csv_loading = {}
+state_lock = threading.Lock()  # search_jobs, ai_jobs and table_pipelines
+json_file_lock = threading.Lock()  # settings.json
+
+# Memory report for the currently cached table (see load_csv_cached)
+csv_memory_stats = {}
+
+# What the cached table was parsed from, by cache key: file size, SHA-1 of
+# those bytes and the header columns. When the file only grew by whole rows
+# the table is extended instead of reloaded (see refresh_appended_rows)
+csv_table_sources = {}
+SOURCE_HASH_CHUNK = 1 << 20  # Bytes hashed per read
+
+# Header and first rows of CSV files, read from the first HEADER_SAMPLE_BYTES
+# without the pandas parser: (csv_path, mtime) -> sample (see read_csv_sample)
+csv_samples = OrderedDict()
+csv_sample_lock = threading.Lock()
+CSV_SAMPLE_CACHE_SIZE = 32
+HEADER_SAMPLE_BYTES = 64 * 1024
+HEADER_SAMPLE_ROWS = 5
+
+# Column profiles of loaded tables: (csv_path, mtime) -> Future of the profile
+csv_profiles = {}
+HLL_PRECISION = 12  # 4096 registers per column, ~1.6% error on distinct counts
+PROFILE_TOP_K = 5  # Most common values kept per column
+
+# Per-column exact/prefix lookup indexes for the cached table, built lazily:
+# column -> (table, index). The table is kept to check which DataFrame an
+# index was built from (see get_column_index)
+csv_column_indexes = {}
+
+# Lineage of the cached table, by cache key: {'id', 'saved'}. A table keeps
+# its lineage when appended rows are refreshed in or derived columns are
+# saved, so result sets built on it can still be persisted ('saved' holds the
+# tokens of derived columns already written; see add_result_column)
+csv_table_lineage = {}
+csv_persist_status = {'status': 'idle'}
+
+# Search modes accepted by /search; 'literal' is the default
+SEARCH_MODES = ('literal', 'exact', 'prefix', 'regex')
+PATTERN_CACHE_SIZE = 128  # Compiled regex patterns kept in memory
+
+# Parallel search: tables with at least this many rows are scanned in row
+# partitions across a thread pool (Arrow string kernels release the GIL)
+PARALLEL_SEARCH_MIN_ROWS = int(os.environ.get("CSV_PARALLEL_MIN_ROWS", 200000))
+SEARCH_WORKERS = int(os.environ.get("CSV_SEARCH_WORKERS", os.cpu_count() or 1))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix='csv-search')
+
+# Long-running work (e.g. finishing a "first page fast" search) runs here so it
+# never waits on its own partitions in search_executor
+background_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='csv-jobs')
+
+# Completed searches: (csv_path, mtime, query, mode) -> (positions, match)
+search_result_cache = OrderedDict()
+SEARCH_RESULT_CACHE_SIZE = 8
+
+# "First page fast" searches still counting in the background, by job id
+search_jobs = OrderedDict()
+MAX_SEARCH_JOBS = 32
+FAST_SEARCH_BLOCK_ROWS = 50000  # Rows scanned per step while filling page 1
+EXPORT_BATCH_ROWS = 50000  # Rows serialized per chunk (Parquet row group) of an export
+XLSX_MAX_ROWS = 1048576  # Excel's sheet row limit, header row included
+
+# AI queries run as background jobs on their own pool, so pending model calls
+# never occupy request threads or the search pools. CSV_AI_ENDPOINT points
+# the app at another Gemini REST compatible server (e.g. a local stub)
+AI_ENDPOINT = os.environ.get("CSV_AI_ENDPOINT", "")
+AI_TIMEOUT = float(os.environ.get("CSV_AI_TIMEOUT", 60))  # Seconds per AI query
+AI_STREAM_KEEPALIVE = 15  # Seconds between SSE keep-alive comments
+ai_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("CSV_AI_WORKERS", 4)), thread_name_prefix='csv-ai')
+# One Gemini client per API key, each carrying its own key, so sessions with
+# different keys never share process-wide configuration or wait on each other
+ai_clients = OrderedDict()
+ai_clients_lock = threading.Lock()
+MAX_AI_CLIENTS = 16
+AI_PROMPT_TOKEN_BUDGET = int(os.environ.get("CSV_AI_PROMPT_TOKENS", 4000))  # Upper bound per prompt
+PROMPT_CHARS_PER_TOKEN = 4  # Estimate used for the budget
+PROMPT_SAMPLE_ROWS = 20  # Rows sampled across the result set
+PROMPT_MAX_COLUMNS = 12  # Most relevant columns shown in profile and sample rows
+PROMPT_VALUE_CHARS = 60  # Longer cell values are cut in the prompt
+
+# Batch AI: a question over the whole result set is mapped over row chunks
+# sized to the prompt budget, at most CSV_AI_BATCH_CONCURRENCY model calls at
+# a time, and the partial answers are reduced into one
+AI_BATCH_CONCURRENCY = int(os.environ.get("CSV_AI_BATCH_CONCURRENCY", 4))
+AI_BATCH_TIMEOUT = float(os.environ.get("CSV_AI_BATCH_TIMEOUT", 1800))  # Seconds per batch job
+AI_BATCH_RETRIES = 4  # Retries per model call on rate limits and transient errors
+AI_BATCH_BACKOFF = 1.0  # Seconds before the first retry; doubles per attempt
+AI_BATCH_MAX_BACKOFF = 60.0
+ai_batch_executor = ThreadPoolExecutor(max_workers=AI_BATCH_CONCURRENCY, thread_name_prefix='csv-ai-batch')
+# Batch jobs run on their own workers so a long batch can't hold up
+# interactive questions on ai_executor
+ai_batch_job_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("CSV_AI_BATCH_JOBS", 1)), thread_name_prefix='csv-ai-batch-job')
+ai_jobs = OrderedDict()
+MAX_AI_JOBS = 32
+
+# Answers to repeated questions about the same results are served from disk;
+# entries expire after CSV_AI_CACHE_TTL seconds and the oldest are dropped
+# beyond CSV_AI_CACHE_SIZE entries
+AI_CACHE_TTL = int(os.environ.get("CSV_AI_CACHE_TTL", 24 * 3600))
+AI_CACHE_SIZE = int(os.environ.get("CSV_AI_CACHE_SIZE", 500))
+ai_response_cache = FileSystemCache(AI_CACHE_FOLDER, threshold=AI_CACHE_SIZE, default_timeout=AI_CACHE_TTL)
+ai_cache_counts = {'hits': 0, 'misses': 0}
+
+# Optional: pyarrow enables Arrow-backed string columns for compact loading
+# and Parquet export
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# Optional: openpyxl enables XLSX export
+try:
+    import openpyxl
+    HAS_OPENPYXL = True
+except ImportError:
+    HAS_OPENPYXL = False
+
+# Columns with at most this share of distinct values, and no more than
+# CATEGORY_MAX_VALUES of them, are stored as categoricals; anything more
+# distinct is cheaper as Arrow strings
+CATEGORY_MAX_RATIO = 0.05
+CATEGORY_MAX_VALUES = 10000
+
+# Shared table mode (CSV_SHARED_TABLE=1): a parsed CSV is written once as an
+# Arrow IPC file and memory-mapped, so separate app processes (e.g. instances
+# behind a sticky load balancer) share one copy of the table through the OS
+# page cache instead of each parsing its own
+SHARED_TABLE_CACHE = os.environ.get("CSV_SHARED_TABLE", "0") == "1"
+SERVER_STARTED = time.time()
+
 # Create uploads directory if it doesn't exist
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# Server-side sessions: chat history, search summaries etc. are stored under
+# SESSION_FOLDER as msgpack and the cookie only carries the session id
+app.config['SESSION_TYPE'] = 'cachelib'
+app.config['SESSION_CACHELIB'] = FileSystemCache(SESSION_FOLDER, threshold=1000)
+app.config['SESSION_SERIALIZATION_FORMAT'] = 'msgpack'
+app.config['SESSION_PERMANENT'] = False
+Session(app)
+
 # --- Caching mechanism for CSV file ---
-def load_csv_cached(csv_path):
+def clear_csv_cache():
+    """Drops the cached table together with everything derived from it."""
+    with csv_cache_lock:
+        csv_cache.clear()
+        csv_table_sources.clear()
+        csv_table_lineage.clear()
+        csv_column_indexes.clear()
+        search_result_cache.clear()
+
+def estimate_object_memory(df):
+    """
+    Estimates how many bytes the DataFrame would take as plain object columns
+    (8-byte pointer plus a Python str of ~49 bytes overhead per cell).
+    """
+    total = int(df.index.memory_usage())
+    for col in df.columns:
+        total += int(df[col].str.len().sum()) + len(df) * (8 + 49)
+    return total
+
+def compact_dataframe(df, profile=None):
+    """
+    Converts string columns to Arrow-backed strings (when pyarrow is installed)
+    and dictionary-encodes low-cardinality columns such as state or status.
+    Cardinalities come from the table's profile when one is available.
+    """
+    string_dtype = pd.StringDtype("pyarrow") if HAS_PYARROW else None
+    num_rows = len(df)
+    profiled = profile['columns'] if profile is not None and profile['rows'] == num_rows else {}
+    for col in df.columns:
+        series = df[col]
+        distinct = profiled[col]['distinct'] if col in profiled else series.nunique()
+        if num_rows and distinct <= min(num_rows * CATEGORY_MAX_RATIO, CATEGORY_MAX_VALUES):
+            df[col] = series.astype('category')
+        elif string_dtype is not None and series.dtype != string_dtype:
+            df[col] = series.astype(string_dtype)
+    return df
+
+def load_csv_cached(csv_path, compact=None):
     """
     Loads the CSV file fully into memory using a caching mechanism.
     It checks the file's modification time and caches the DataFrame.
+    With compact=True (default: the 'compact_strings' setting) columns are
+    stored as Arrow strings/categoricals and the memory saving is reported.
+    Loading is single-flight: concurrent requests for a cold file wait for
+    the one read_csv already running. A file that only had rows appended
+    since it was cached is refreshed incrementally.
     """
+    if compact is None:
+        compact = persistent_settings.get('compact_strings', False)
     try:
         mtime = os.path.getmtime(csv_path)
     except Exception as e:
         print(f"Error getting file modification time: {e}")
         return pd.DataFrame()
-    key = (csv_path, mtime)
-    if key in csv_cache:
-        return csv_cache[key]
+    key = (csv_path, mtime, bool(compact))
+    while True:
+        with csv_cache_lock:
+            if key in csv_cache:
+                return csv_cache[key]
+            loading = csv_loading.get(key)
+            if loading is None:
+                loading = csv_loading[key] = threading.Event()
+                break
+        # Another request is parsing this file: wait, then re-check the cache
+        loading.wait()
+    try:
+        df = refresh_appended_rows(csv_path, key)
+        if df is None:
+            df, stats, source = read_csv_table(csv_path, compact, ready_table_profile(csv_path, mtime))
+            with csv_cache_lock:
+                # Clear previous cache entries (assuming one file at a time)
+                clear_csv_cache()
+                csv_memory_stats.clear()
+                csv_memory_stats.update(stats)
+                csv_cache[key] = df
+                csv_table_lineage[key] = {'id': uuid.uuid4().hex, 'saved': set()}
+                if source is not None:
+                    csv_table_sources[key] = source
+        start_table_profile(csv_path, mtime, df)
+        return df
+    finally:
+        with csv_cache_lock:
+            csv_loading.pop(key, None)
+        loading.set()
+
+def read_csv_table(csv_path, compact, profile=None):
+    """
+    Parses (or maps, in shared table mode) csv_path; returns (df, memory
+    stats, source record). The source record (see csv_source_record) covers
+    exactly the bytes parsed; it is None in shared table mode, where tables
+    are always reloaded whole.
+    """
+    shared = SHARED_TABLE_CACHE and HAS_PYARROW
+    df = load_shared_table(csv_path, compact) if shared else None
+    if df is not None:
+        return df, {
+            'csv_path': csv_path,
+            'compact': bool(compact),
+            'shared': True,
+            'bytes_after': int(df.memory_usage(deep=True).sum())
+        }, None
+    dtype = pd.StringDtype("pyarrow") if compact and HAS_PYARROW else str
+    # Hashed while pandas reads it, so rows appended during the parse are
+    # left for the next refresh instead of being counted as loaded
+    with open(csv_path, 'rb') as f:
+        reader = HashingReader(f)
+        df = pd.read_csv(io.BufferedReader(reader), dtype=dtype, keep_default_na=False)
+    source = None if shared else {'size': reader.size, 'digest': reader.hasher.hexdigest(), 'columns': list(df.columns)}
+    if compact:
+        before = estimate_object_memory(df)
+        df = compact_dataframe(df, profile)
+        after = int(df.memory_usage(deep=True).sum())
+        stats = {
+            'csv_path': csv_path,
+            'compact': True,
+            'bytes_before_estimate': before,
+            'bytes_after': after,
+            'categorical_columns': [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+        }
+        print(f"Compact load of {csv_path}: ~{before / 1e6:.1f} MB as objects (estimated) -> {after / 1e6:.1f} MB")
     else:
-        df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
-        # Clear previous cache entries (assuming one file at a time)
-        csv_cache.clear()
-        csv_cache[key] = df
+        stats = {
+            'csv_path': csv_path,
+            'compact': False,
+            'bytes_after': int(df.memory_usage(deep=True).sum())
+        }
+    if shared and write_shared_table(df, csv_path, compact):
+        # Switch to the mapped copy so this process shares it too
+        mapped = load_shared_table(csv_path, compact)
+        if mapped is not None:
+            df = mapped
+    return df, stats, source
+
+# --- Incremental Refresh of Appended Rows ---
+class HashingReader(io.RawIOBase):
+    """Read-only file object that keeps a SHA-1 and count of the bytes read through it."""
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.hasher = hashlib.sha1()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.raw.readinto(buffer)
+        self.hasher.update(memoryview(buffer)[:count])
+        self.size += count
+        return count
+
+def csv_source_record(csv_path, columns):
+    """Size and SHA-1 of csv_path as it is now, plus its header columns."""
+    hasher = hashlib.sha1()
+    size = 0
+    with open(csv_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SOURCE_HASH_CHUNK), b''):
+            hasher.update(chunk)
+            size += len(chunk)
+    return {'size': size, 'digest': hasher.hexdigest(), 'columns': columns}
+
+def read_appended_rows(csv_path, source, compact):
+    """
+    The rows appended to csv_path since source was recorded, as a DataFrame
+    with the header columns, and the updated source record. Returns
+    (None, None) if the first source['size'] bytes changed or the old file
+    did not end with a complete row. A trailing partial row is left for the
+    next refresh.
+    """
+    size = os.path.getsize(csv_path)
+    if size < source['size']:
+        return None, None
+    hasher = hashlib.sha1()
+    last = b''
+    with open(csv_path, 'rb') as f:
+        remaining = source['size']
+        while remaining:
+            chunk = f.read(min(remaining, SOURCE_HASH_CHUNK))
+            if not chunk:
+                return None, None
+            hasher.update(chunk)
+            remaining -= len(chunk)
+            last = chunk[-1:]
+        if hasher.hexdigest() != source['digest'] or last not in (b'', b'\n'):
+            return None, None
+        data = f.read(size - source['size'])
+    data = data[:data.rfind(b'\n') + 1]
+    hasher.update(data)
+    updated = dict(source, size=source['size'] + len(data), digest=hasher.hexdigest())
+    if not data.strip():
+        return pd.DataFrame(columns=source['columns']), updated
+    dtype = pd.StringDtype("pyarrow") if compact and HAS_PYARROW else str
+    # index_col=False: rows with an extra field must not turn into an index
+    tail = pd.read_csv(io.BytesIO(data), header=None, names=source['columns'], index_col=False,
+                       dtype=dtype, keep_default_na=False)
+    return tail, updated
+
+def append_table_rows(df, tail):
+    """
+    df with the rows of tail appended and renumbered after df's. Columns keep
+    df's dtypes (categoricals gain any new categories); derived columns that
+    tail lacks are filled with ''.
+    """
+    if not len(tail):
         return df
+    columns = {}
+    for column in df.columns:
+        series = df[column]
+        values = tail[column] if column in tail.columns else pd.Series('', index=tail.index)
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            new = pd.Index(values.unique()).difference(series.cat.categories)
+            if len(new):
+                series = series.cat.add_categories(new)
+        columns[column] = pd.concat([series, values.astype(series.dtype)], ignore_index=True)
+    return pd.DataFrame(columns)
+
+def refresh_appended_rows(csv_path, key):
+    """
+    Brings the cached table of an older version of csv_path up to date when
+    the file only grew by whole rows: just the new bytes are parsed, and the
+    column indexes, literal/regex search results and the profile are extended
+    to cover them. Returns the table cached under key, or None if a full
+    reload is needed.
+    """
+    compact = key[2]
+    with csv_cache_lock:
+        old_key = next((k for k in csv_table_sources if k[0] == csv_path and k[2] == compact), None)
+        if old_key is None or old_key not in csv_cache:
+            return None
+        df = csv_cache[old_key]
+        source = csv_table_sources[old_key]
+    try:
+        tail, source = read_appended_rows(csv_path, source, compact)
+    except Exception as e:
+        print(f"Error reading rows appended to {csv_path}: {e}")
+        return None
+    if tail is None:
+        return None
+    with csv_cache_lock:
+        if csv_cache.get(old_key) is not df:
+            return None  # Cleared or replaced while the new rows were parsed
+        offset = len(df)
+        table = append_table_rows(df, tail)
+        added = table.iloc[offset:]
+        for column, (indexed, index) in list(csv_column_indexes.items()):
+            if indexed is df:
+                csv_column_indexes[column] = (table, extend_column_index(index, added[column], offset))
+            else:
+                del csv_column_indexes[column]
+        searches = list(search_result_cache.items())
+        search_result_cache.clear()
+        for (path, mtime, search_text, mode), (positions, match) in searches:
+            # Exact/prefix searches are cheap to redo from the extended indexes
+            if path != csv_path or mtime != old_key[1] or mode not in ('literal', 'regex'):
+                continue
+            groups = parse_search_query(search_text, list(table.columns))
+            new_positions, new_match = evaluate_search_terms(added, groups, mode)
+            search_result_cache[(csv_path, key[1], search_text, mode)] = (
+                np.concatenate([positions, new_positions + offset]), np.vstack([match, new_match])
+            )
+        csv_cache.clear()
+        csv_cache[key] = table
+        csv_table_sources.clear()
+        csv_table_sources[key] = source
+        lineage = csv_table_lineage.pop(old_key, None)
+        csv_table_lineage.clear()
+        if lineage is not None:
+            csv_table_lineage[key] = lineage
+        csv_memory_stats['bytes_after'] = int(table.memory_usage(deep=True).sum())
+        base = csv_profiles.get((csv_path, old_key[1]))
+        if base is not None and (csv_path, key[1]) not in csv_profiles:
+            csv_profiles[(csv_path, key[1])] = background_executor.submit(
+                extend_table_profile, base, added, table, csv_path
+            )
+    if len(tail):
+        print(f"Appended {len(tail)} rows to the cached table of {csv_path}")
+    return table
+
+# --- Column Profiles ---
+# Each loaded table is profiled once in the background: per column the null
+# and empty counts, an approximate distinct count (HyperLogLog sketch), the
+# most common values and the min/max value length. Profiles are keyed by
+# (csv_path, mtime) so switching the compact setting reuses them.
+def hll_registers(series):
+    """HyperLogLog registers (2**HLL_PRECISION of them) for the values of series."""
+    p = HLL_PRECISION
+    hashes = pd.util.hash_pandas_object(series, index=False).to_numpy(dtype=np.uint64)
+    buckets = (hashes >> np.uint64(64 - p)).astype(np.int64)
+    rest = hashes << np.uint64(p)
+    # Rank = position of the first set bit in the remaining bits, found on
+    # 32-bit halves so the float log2 stays exact
+    high = (rest >> np.uint64(32)).astype(np.int64)
+    low = (rest & np.uint64(0xffffffff)).astype(np.int64)
+    leading_zeros = np.where(high > 0, 32 - bit_length(high), 64 - bit_length(low))
+    ranks = np.minimum(leading_zeros + 1, 64 - p + 1)
+    # Max rank per bucket: flag every (bucket, rank) seen, take the highest
+    seen = np.bincount(buckets * 64 + ranks, minlength=(1 << p) * 64).reshape(1 << p, 64) > 0
+    return np.where(seen.any(axis=1), 63 - np.argmax(seen[:, ::-1], axis=1), 0)
+
+def bit_length(values):
+    return np.where(values > 0, np.floor(np.log2(np.maximum(values, 1).astype(np.float64))) + 1, 0).astype(np.int64)
+
+def hll_estimate(registers):
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * np.log(m / zeros)  # Linear counting for small cardinalities
+    return int(round(estimate))
+
+def profile_column(series):
+    present = series[series.notna()]
+    values = present.astype(object).astype(str)
+    lengths = values.str.len()
+    non_empty = values[values.str.strip() != '']
+    top = non_empty.value_counts().head(PROFILE_TOP_K)
+    registers = hll_registers(non_empty)
+    return {
+        'nulls': int(len(series) - len(present)),
+        'empty': int(len(present) - len(non_empty)),
+        'distinct': hll_estimate(registers) if len(non_empty) else 0,
+        'top': [{'value': value, 'count': int(count)} for value, count in top.items()],
+        'min_length': int(lengths.min()) if len(lengths) else 0,
+        'max_length': int(lengths.max()) if len(lengths) else 0
+    }, registers
+
+def profile_table(df, csv_path):
+    """Profiles every column of df; 'sketches' holds the HLL registers by column."""
+    started = time.time()
+    columns = {}
+    sketches = {}
+    for column in df.columns:
+        columns[column], sketches[column] = profile_column(df[column])
+    return {
+        'csv_path': csv_path,
+        'rows': len(df),
+        'columns': columns,
+        'distinct_is_approximate': True,
+        'seconds': round(time.time() - started, 3),
+        'sketches': sketches
+    }
+
+def extend_table_profile(base, added, table, csv_path):
+    """
+    The profile of table, which is the profiled table (base, a Future) plus
+    the rows in added. Counts add up and HLL registers merge by taking the
+    maximum; top values are re-ranked from both top lists, so a value that
+    made neither list is missed.
+    """
+    try:
+        profile = base.result()
+    except Exception:
+        return profile_table(table, csv_path)
+    started = time.time()
+    columns = dict(profile['columns'])
+    sketches = dict(profile['sketches'])
+    for column in added.columns:
+        stats, registers = profile_column(added[column])
+        old = columns.get(column)
+        if old is None:
+            columns[column], sketches[column] = profile_column(table[column])
+            continue
+        registers = np.maximum(sketches[column], registers)
+        counts = {}
+        for item in old['top'] + stats['top']:
+            counts[item['value']] = counts.get(item['value'], 0) + item['count']
+        top = sorted(counts.items(), key=lambda item: -item[1])[:PROFILE_TOP_K]
+        lengths = [(entry['min_length'], entry['max_length']) for entry, present in (
+            (old, profile['rows'] - old['nulls']), (stats, len(added) - stats['nulls'])
+        ) if present]
+        columns[column] = {
+            'nulls': old['nulls'] + stats['nulls'],
+            'empty': old['empty'] + stats['empty'],
+            'distinct': hll_estimate(registers) if registers.any() else 0,
+            'top': [{'value': value, 'count': count} for value, count in top],
+            'min_length': min((low for low, _ in lengths), default=0),
+            'max_length': max((high for _, high in lengths), default=0)
+        }
+        sketches[column] = registers
+    return dict(profile, rows=len(table), columns=columns, seconds=round(time.time() - started, 3), sketches=sketches)
+
+def start_table_profile(csv_path, mtime, df):
+    """Submits the profiling pass for a freshly loaded table unless one exists."""
+    with csv_cache_lock:
+        for key in [k for k in csv_profiles if k != (csv_path, mtime)]:
+            del csv_profiles[key]
+        if (csv_path, mtime) not in csv_profiles:
+            csv_profiles[(csv_path, mtime)] = background_executor.submit(profile_table, df, csv_path)
+        return csv_profiles[(csv_path, mtime)]
+
+def get_table_profile(csv_path, wait=True):
+    """
+    The profile of the cached table for csv_path, or None if wait is False and
+    it is still being computed.
+    """
+    df = load_csv_cached(csv_path)
+    try:
+        mtime = os.path.getmtime(csv_path)
+    except OSError:
+        return None
+    future = start_table_profile(csv_path, mtime, df)
+    if not wait and not future.done():
+        return None
+    try:
+        return future.result()
+    except Exception as e:
+        print(f"Error profiling {csv_path}: {e}")
+        return None
+
+def ready_table_profile(csv_path, mtime):
+    """The finished profile for (csv_path, mtime), if any, without waiting."""
+    with csv_cache_lock:
+        future = csv_profiles.get((csv_path, mtime))
+    if future is None or not future.done() or future.exception() is not None:
+        return None
+    return future.result()
+
+def public_profile(profile):
+    return {key: value for key, value in profile.items() if key != 'sketches'}
+
+def profile_prompt_text(profile, columns):
+    """A line per column summarizing the profile for the AI prompt."""
+    lines = []
+    for column in columns:
+        stats = profile['columns'].get(column)
+        if stats is None:
+            continue  # Derived columns added after profiling
+        top = ', '.join(f"{str(item['value'])[:40]} ({item['count']})" for item in stats['top'])
+        lines.append(
+            f"- {column}: ~{stats['distinct']} distinct, {stats['empty'] + stats['nulls']} empty, "
+            f"length {stats['min_length']}-{stats['max_length']}, top: {top or 'none'}"
+        )
+    return '\n'.join(lines)
+
+# --- Shared Memory-Mapped Tables ---
+def shared_table_path(csv_path, compact):
+    digest = hashlib.sha1(os.path.abspath(csv_path).encode('utf-8')).hexdigest()
+    return os.path.join(TABLE_CACHE_FOLDER, f"{digest}{'-compact' if compact else ''}.arrow")
+
+def shared_table_source(csv_path):
+    stat = os.stat(csv_path)
+    return json.dumps({'mtime': stat.st_mtime, 'size': stat.st_size}).encode('utf-8')
+
+def arrow_string_dtype(arrow_type):
+    # Strings stay Arrow-backed (zero-copy views of the mapped file)
+    if pyarrow.types.is_string(arrow_type) or pyarrow.types.is_large_string(arrow_type):
+        return pd.ArrowDtype(arrow_type)
+    return None
+
+def load_shared_table(csv_path, compact):
+    """Memory-maps the Arrow copy of csv_path; None if missing or stale."""
+    path = shared_table_path(csv_path, compact)
+    if not os.path.exists(path):
+        return None
+    try:
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path))
+        if (reader.schema.metadata or {}).get(b'csv_source') != shared_table_source(csv_path):
+            return None
+        return reader.read_all().to_pandas(types_mapper=arrow_string_dtype)
+    except Exception as e:
+        print(f"Error mapping shared table {path}: {e}")
+        return None
+
+def write_shared_table(df, csv_path, compact):
+    """Writes df as an Arrow IPC file for other workers; atomic via os.replace."""
+    if not os.path.exists(TABLE_CACHE_FOLDER):
+        os.makedirs(TABLE_CACHE_FOLDER, exist_ok=True)
+    path = shared_table_path(csv_path, compact)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'csv_source'] = shared_table_source(csv_path)
+        table = table.replace_schema_metadata(metadata)
+        with pyarrow.OSFile(temp_path, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_path, path)
+        return True
+    except Exception as e:
+        print(f"Error writing shared table {path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+# --- Derived Columns ---
+# combine/merge columns live in the result set that added them (on a shallow
+# copy of the table, see add_result_column), so they are private to the
+# pipeline and go away on undo. persist_overlay writes them to the CSV.
+def table_lineage(df):
+    """The lineage record of df if it is a cached table, else None."""
+    with csv_cache_lock:
+        for key, table in csv_cache.items():
+            if table is df:
+                return csv_table_lineage.get(key)
+    return None
+
+def unsaved_columns(result_set):
+    """Derived columns of result_set that are not written to the CSV yet."""
+    derived = result_set.get('derived')
+    if not derived:
+        return []
+    saved = derived['lineage']['saved'] if derived['lineage'] is not None else set()
+    return [column for column, token in derived['columns'].items() if token not in saved]
+
+def persist_overlay(csv_path, result_set):
+    """
+    Starts a background write of the cached table plus the derived columns of
+    result_set to csv_path. The CSV is written to a temporary file and swapped
+    in with os.replace, and the written table becomes the cached one instead
+    of being reloaded. Returns None once started, else an error message.
+    """
+    derived = result_set.get('derived')
+    columns = unsaved_columns(result_set)
+    df = load_csv_cached(csv_path)
+    with csv_cache_lock:
+        if csv_persist_status.get('status') == 'running':
+            return 'A save is already in progress'
+        lineage = table_lineage(df)
+        if derived is None or lineage is None or derived['lineage'] is not lineage or len(df) < derived['rows']:
+            return 'The CSV file changed since these columns were added; run the search again.'
+        snapshot = df.copy(deep=False)
+        for column in derived['columns']:
+            values = result_set['df'][column].to_numpy(dtype=object)
+            # Rows appended to the file since the column was derived stay empty
+            snapshot[column] = np.concatenate([values, np.full(len(df) - len(values), '', dtype=object)])
+        csv_persist_status.clear()
+        csv_persist_status.update({'status': 'running', 'csv_path': csv_path, 'columns': columns})
+    background_executor.submit(write_overlay, csv_path, df, snapshot, dict(derived['columns']))
+    return None
+
+def write_overlay(csv_path, df, snapshot, tokens):
+    temp_path = f"{csv_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        snapshot.to_csv(temp_path, index=False)
+        source = csv_source_record(temp_path, list(snapshot.columns))
+        with csv_cache_lock:
+            os.replace(temp_path, csv_path)
+            mtime = os.path.getmtime(csv_path)
+            for key in [k for k in csv_cache if k[0] == csv_path and csv_cache[k] is df]:
+                new_key = (csv_path, mtime) + key[2:]
+                del csv_cache[key]
+                csv_cache[new_key] = snapshot
+                lineage = csv_table_lineage.pop(key, None)
+                if lineage is not None:
+                    lineage['saved'].update(tokens.values())
+                    csv_table_lineage[new_key] = lineage
+                if csv_table_sources.pop(key, None) is not None:
+                    csv_table_sources[new_key] = source
+            # Cached matches are as wide as the old table; overwritten columns need new indexes
+            for key in [k for k in search_result_cache if k[0] == csv_path]:
+                del search_result_cache[key]
+            for column, (indexed, index) in list(csv_column_indexes.items()):
+                if indexed is df and column not in tokens:
+                    csv_column_indexes[column] = (snapshot, index)
+                else:
+                    del csv_column_indexes[column]
+            csv_persist_status.update({'status': 'done'})
+    except Exception as e:
+        print(f"Error saving derived columns: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        with csv_cache_lock:
+            csv_persist_status.update({'status': 'error', 'error': str(e)})
 
 # --- Settings and Chat History Helpers ---
 def load_settings():
@@ -67,34 +788,105 @@ def load_settings():
         'csv_path': DEFAULT_CSV_PATH,
         'model': 'gemini-2.0-flash-thinking-exp-01-21',
         'dark_mode': False,
-        'rows_per_page': DEFAULT_ROWS_PER_PAGE
+        'rows_per_page': DEFAULT_ROWS_PER_PAGE,
+        'compact_strings': False
     }
 
+def atomic_write_json(path, data):
+    """Writes JSON to a temporary file and swaps it in, so readers never see a partial file."""
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with json_file_lock:
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(data, f, indent=4)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
 def save_settings(settings):
     try:
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(settings, f, indent=4)
+        atomic_write_json(SETTINGS_FILE, settings)
     except Exception as e:
         print(f"Error saving settings: {e}")
 
-def load_chat_history():
-    try:
-        if os.path.exists(CHAT_HISTORY_FILE):
+# Chat history lives in SQLite: appending or deleting an entry touches one
+# row, pages are read with LIMIT/OFFSET and past queries are searched through
+# an FTS5 index. An existing chat_history.json is imported on first use.
+def chat_db():
+    conn = sqlite3.connect(CHAT_DB_FILE, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_chat_store():
+    """Creates the chat tables (and imports the old JSON history) if needed; returns FTS availability."""
+    with closing(chat_db()) as conn, conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_entries ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, query TEXT NOT NULL, response TEXT NOT NULL, timestamp TEXT NOT NULL)"
+        )
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(query, content='chat_entries', content_rowid='id')")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS chat_fts_insert AFTER INSERT ON chat_entries BEGIN "
+                         "INSERT INTO chat_fts(rowid, query) VALUES (new.id, new.query); END")
+            conn.execute("CREATE TRIGGER IF NOT EXISTS chat_fts_delete AFTER DELETE ON chat_entries BEGIN "
+                         "INSERT INTO chat_fts(chat_fts, rowid, query) VALUES ('delete', old.id, old.query); END")
+            has_fts = True
+        except sqlite3.OperationalError:
+            has_fts = False  # SQLite built without FTS5: searches fall back to LIKE
+        empty = conn.execute("SELECT COUNT(*) FROM chat_entries").fetchone()[0] == 0
+    if empty and os.path.exists(CHAT_HISTORY_FILE):
+        try:
             with open(CHAT_HISTORY_FILE, 'r') as f:
-                return json.load(f)
-    except Exception as e:
-        print(f"Error loading chat history: {e}")
-    return []
+                entries = json.load(f)
+            with closing(chat_db()) as conn, conn:
+                conn.executemany(
+                    "INSERT INTO chat_entries (query, response, timestamp) VALUES (?, ?, ?)",
+                    [(entry['query'], entry['response'], entry['timestamp']) for entry in entries]
+                )
+            os.replace(CHAT_HISTORY_FILE, CHAT_HISTORY_FILE + '.imported')
+        except Exception as e:
+            print(f"Error importing chat history: {e}")
+    return has_fts
 
-def save_chat_history(chat_history):
-    try:
-        with open(CHAT_HISTORY_FILE, 'w') as f:
-            json.dump(chat_history, f, indent=4)
-    except Exception as e:
-        print(f"Error saving chat history: {e}")
+def add_chat_entry(query, response, timestamp):
+    with closing(chat_db()) as conn, conn:
+        cursor = conn.execute("INSERT INTO chat_entries (query, response, timestamp) VALUES (?, ?, ?)",
+                              (query, response, timestamp))
+        return cursor.lastrowid
+
+def remove_chat_entry(entry_id):
+    with closing(chat_db()) as conn, conn:
+        conn.execute("DELETE FROM chat_entries WHERE id = ?", (entry_id,))
+
+def clear_chat_entries():
+    with closing(chat_db()) as conn, conn:
+        conn.execute("DELETE FROM chat_entries")
+
+def chat_history_page(page=1, search=''):
+    """One page of chat entries, newest first, optionally matching search; returns (entries, page, total_pages)."""
+    where, params = '', []
+    words = re.findall(r'\w+', search)
+    if words and CHAT_HAS_FTS:
+        # Every word must occur; the last one may still be being typed
+        where = "WHERE id IN (SELECT rowid FROM chat_fts WHERE chat_fts MATCH ?)"
+        params.append(' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*')
+    elif search.strip():
+        where = "WHERE query LIKE ?"
+        params.append(f"%{search.strip()}%")
+    with closing(chat_db()) as conn:
+        total = conn.execute(f"SELECT COUNT(*) FROM chat_entries {where}", params).fetchone()[0]
+        total_pages = max(1, (total + CHAT_PAGE_SIZE - 1) // CHAT_PAGE_SIZE)
+        page = min(max(1, page), total_pages)
+        rows = conn.execute(
+            f"SELECT id, query, response, timestamp FROM chat_entries {where} ORDER BY id DESC LIMIT ? OFFSET ?",
+            params + [CHAT_PAGE_SIZE, (page - 1) * CHAT_PAGE_SIZE]
+        ).fetchall()
+    return [dict(row) for row in rows], page, total_pages
 
 persistent_settings = load_settings()
-persistent_chat_history = load_chat_history()
+CHAT_HAS_FTS = init_chat_store()
 
 @app.teardown_appcontext
 def clear_api_key(exception):
@@ -117,201 +909,960 @@ def restore_original():
     if not os.path.exists(csv_path):
         return jsonify({'error': f'CSV file not found at path: {csv_path}'}), 400
     
+    page = (request.get_json(silent=True) or {}).get('page', 1)
+    
     # Clear any combined columns from session
     if 'combined_columns' in session:
         session.pop('combined_columns', None)
     
-    # Reload original data
-    df = load_csv_cached(csv_path)
-    if df.empty:
+    # Reset the server-side view to all rows; only the requested page is sent
+    result_set = all_rows_result_set(csv_path)
+    if not len(result_set['positions']):
         return jsonify({'error': 'No data to restore'}), 400
-    
-    # Convert to our search results format
-    search_results = []
-    for idx, row in df.iterrows():
-        search_results.append({
-            'row_index': idx,
-            'data': row.to_dict(),
-            'matching_columns': []
-        })
-    
-    # Update session with original data
-    session['current_results'] = search_results
+    session.pop('last_query', None)
+    session.pop('search_job', None)
+    session['view_all'] = True
+    pipeline = start_pipeline(csv_path, '', session.get('search_mode', 'literal'), result_set)
+    payload, summary, total_pages = table_payload(result_set, page)
+    session['search_summary'] = summary
     
     return jsonify({
         'status': 'success',
         'message': 'Original data restored',
-        'data': search_results
+        **payload,
+        'total_pages': total_pages,
+        'total_rows': summary['num_rows'],
+        'steps': pipeline_step_names(pipeline)
     })
 
+# --- Search Query Parsing ---
+def tokenize_query(text):
+    """Splits a query on whitespace, keeping "quoted phrases" together."""
+    lexer = shlex.shlex(text, posix=True)
+    lexer.whitespace_split = True
+    lexer.commenters = ''
+    lexer.escape = ''
+    try:
+        return list(lexer)
+    except ValueError:
+        # Unbalanced quotes: fall back to plain whitespace splitting
+        return text.split()
+
+def resolve_field_columns(field, columns):
+    """
+    Maps a query field to table columns: an exact (case-insensitive) column
+    name wins, otherwise every column containing the field, so 'email'
+    covers Email1..Email5.
+    """
+    field_lower = field.lower()
+    exact = [col for col in columns if col.lower() == field_lower]
+    if exact:
+        return exact
+    return [col for col in columns if field_lower in col.lower()]
+
+def parse_search_query(text, columns):
+    """
+    Parses the search syntax into OR-groups of AND-ed terms, e.g.
+    'email:gmail.com', 'state:TX AND city:austin', 'name:"john smith" OR acme'.
+    Each term is {'value': ..., 'columns': [...]} where columns is None for
+    an unqualified term (all columns). Adjacent terms are AND-ed. A plain
+    query without fields, quotes or operators stays a single phrase.
+    """
+    groups = [[]]
+    structured = '"' in text
+    for token in tokenize_query(text):
+        if token in ('AND', 'OR'):
+            structured = True
+            if token == 'OR' and groups[-1]:
+                groups.append([])
+            continue
+        field, sep, value = token.partition(':')
+        term_columns = resolve_field_columns(field, columns) if sep and field and value else []
+        if term_columns:
+            structured = True
+            groups[-1].append({'value': value, 'columns': term_columns})
+        else:
+            groups[-1].append({'value': token, 'columns': None})
+    if not structured:
+        return [[{'value': text, 'columns': None}]]
+    return [group for group in groups if group]
+
+# --- Search Modes: Pattern Cache and Column Indexes ---
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_search_pattern(pattern):
+    """Compiles a case-insensitive regex once; re.error propagates to the caller."""
+    return re.compile(pattern, re.IGNORECASE)
+
+def build_column_index(series):
+    """
+    Builds a lookup index over the lower-cased values of one column: sorted
+    distinct values (exact values and prefix ranges are found via bisect)
+    and row positions grouped by rank.
+    """
+    codes, uniques = pd.factorize(series.astype(str).str.lower())
+    uniques = np.asarray(uniques, dtype=object)
+    order = np.argsort(uniques)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    ranked_codes = rank[codes]
+    values = uniques[order].tolist()
+    return {
+        'values': values,
+        'rows': np.argsort(ranked_codes, kind='stable'),
+        'offsets': np.concatenate(([0], np.cumsum(np.bincount(ranked_codes, minlength=len(values)))))
+    }
+
+def extend_column_index(index, series, offset):
+    """
+    The index of a column that grew by series (rows from offset on): merged
+    from index and an index of the new rows, so existing values are not
+    lower-cased and factorized again.
+    """
+    added = build_column_index(series)
+    old_values = index['values']
+    # Ranks of the new rows' values among the old ones; unseen values are
+    # inserted, which shifts the old ranks after them
+    where = np.array([bisect.bisect_left(old_values, value) for value in added['values']], dtype=np.int64)
+    known = np.array([i < len(old_values) and old_values[i] == value for i, value in zip(where, added['values'])], dtype=bool)
+    inserted = where[~known]
+    values = list(heapq.merge(old_values, [value for value, seen in zip(added['values'], known) if not seen]))
+    old_ranks = np.arange(len(old_values)) + np.searchsorted(inserted, np.arange(len(old_values)), side='right')
+    added_ranks = np.empty(len(where), dtype=np.int64)
+    added_ranks[known] = old_ranks[where[known]]
+    added_ranks[~known] = inserted + np.arange(len(inserted))
+    old_counts = np.bincount(old_ranks, weights=np.diff(index['offsets']), minlength=len(values)).astype(np.int64)
+    added_counts = np.bincount(added_ranks, weights=np.diff(added['offsets']), minlength=len(values)).astype(np.int64)
+    # New rows go after the old rows of the same value, keeping each group sorted
+    row_ranks = np.repeat(added_ranks, np.diff(added['offsets']))
+    return {
+        'values': values,
+        'rows': np.insert(index['rows'], np.cumsum(old_counts)[row_ranks], added['rows'] + offset),
+        'offsets': np.concatenate(([0], np.cumsum(old_counts + added_counts)))
+    }
+
+def get_column_index(df, column):
+    """
+    The index of df[column]. Indexes are kept only for the cached table: a
+    search still running on a table that was cleared or replaced gets a
+    fresh index that is not stored.
+    """
+    entry = csv_column_indexes.get(column)
+    if entry is not None and entry[0] is df:
+        return entry[1]
+    # Built under its own lock so concurrent searches don't index twice
+    with csv_index_lock:
+        entry = csv_column_indexes.get(column)
+        if entry is not None and entry[0] is df:
+            return entry[1]
+        index = build_column_index(df[column])
+        with csv_cache_lock:
+            if any(table is df for table in csv_cache.values()):
+                csv_column_indexes[column] = (df, index)
+    return index
+
+def index_lookup(index, value, mode):
+    """Sorted row positions whose value equals (exact) or starts with (prefix) value."""
+    value = value.lower()
+    lo = bisect.bisect_left(index['values'], value)
+    if mode == 'exact':
+        if lo == len(index['values']) or index['values'][lo] != value:
+            return np.empty(0, dtype=np.int64)
+        return index['rows'][index['offsets'][lo]:index['offsets'][lo + 1]]
+    hi = bisect.bisect_left(index['values'], value + '\U0010ffff')
+    return np.sort(index['rows'][index['offsets'][lo]:index['offsets'][hi]])
+
+def regex_contains(col, pattern):
+    if isinstance(col.dtype, pd.ArrowDtype):
+        # Arrow kernels (RE2) take the pattern text; fall back for re-only syntax
+        try:
+            return col.str.contains(pattern.pattern, case=False, na=False)
+        except (ValueError, NotImplementedError):
+            col = col.astype(object)
+    return col.str.contains(pattern, na=False)
+
+def term_mask(frame, value, mode='literal'):
+    """Boolean matrix (rows x columns of frame) of cells matching value."""
+    if mode == 'regex':
+        pattern = compile_search_pattern(value)
+        return frame.apply(lambda col: regex_contains(col, pattern)).to_numpy(dtype=bool)
+    return frame.apply(lambda col: col.str.contains(value, case=False, regex=False, na=False)).to_numpy(dtype=bool)
+
+def arrow_backed(dtype):
+    """True for Arrow-backed string dtypes, whose kernels release the GIL."""
+    if isinstance(dtype, pd.ArrowDtype):
+        return True
+    return isinstance(dtype, pd.StringDtype) and dtype.storage == 'pyarrow'
+
+def parallel_term_mask(frame, value, mode='literal'):
+    """
+    term_mask, choosing per column how to scan. Arrow-backed columns are
+    split into row-range partitions evaluated on search_executor (their
+    kernels release the GIL) and the partial masks are stacked back in
+    partition order. Categorical columns are matched once per category and
+    mapped through their codes. Other columns (object and python strings
+    hold the GIL in str.contains) and small frames (below
+    PARALLEL_SEARCH_MIN_ROWS) are scanned inline, while the partitions run.
+    """
+    num_rows = len(frame)
+    mask = np.zeros(frame.shape, dtype=bool)
+    category_cols = [j for j, dtype in enumerate(frame.dtypes) if isinstance(dtype, pd.CategoricalDtype)]
+    arrow_cols = [j for j, dtype in enumerate(frame.dtypes) if arrow_backed(dtype)]
+    special = set(category_cols) | set(arrow_cols)
+    inline_cols = [j for j in range(frame.shape[1]) if j not in special]
+    if SEARCH_WORKERS < 2 or num_rows < PARALLEL_SEARCH_MIN_ROWS:
+        inline_cols = sorted(inline_cols + arrow_cols)
+        arrow_cols = []
+    futures = []
+    if arrow_cols:
+        step = -(-num_rows // SEARCH_WORKERS)
+        futures = [
+            search_executor.submit(term_mask, frame.iloc[start:start + step, arrow_cols], value, mode)
+            for start in range(0, num_rows, step)
+        ]
+    for j in category_cols:
+        column = frame.iloc[:, j]
+        hits = term_mask(column.cat.categories.to_frame(index=False), value, mode)[:, 0]
+        # Code -1 (a missing value) picks the appended False
+        mask[:, j] = np.append(hits, False)[column.cat.codes.to_numpy()]
+    if inline_cols:
+        mask[:, inline_cols] = term_mask(frame.iloc[:, inline_cols], value, mode)
+    if futures:
+        mask[:, arrow_cols] = np.vstack([future.result() for future in futures])
+    return mask
+
+def index_term_mask(df, candidates, col_idx, value, mode):
+    """Like term_mask for exact/prefix modes, answered from column indexes."""
+    mask = np.zeros((len(candidates), len(col_idx)), dtype=bool)
+    for j, i in enumerate(col_idx):
+        rows = index_lookup(get_column_index(df, df.columns[i]), value, mode)
+        if len(candidates) == len(df):
+            mask[rows, j] = True
+        else:
+            mask[:, j] = np.isin(candidates, rows, assume_unique=True)
+    return mask
+
+def evaluate_search_terms(df, groups, mode='literal'):
+    """
+    Evaluates parsed query groups against df, touching only the columns each
+    term references. Within a group, terms are applied one after another on
+    the surviving row positions (a sorted index array), so every further term
+    only scans the candidates left by the previous ones. Groups are unioned.
+    Returns (positions, match) where positions is a sorted array of row
+    positions and match is a bool matrix (len(positions) x len(df.columns)).
+    """
+    col_positions = {col: i for i, col in enumerate(df.columns)}
+    all_rows = np.arange(len(df))
+    hits = []
+    positions = np.empty(0, dtype=np.int64)
+    for group in groups:
+        candidates = all_rows
+        # Column-qualified terms first: they are narrower and cheaper
+        for term in sorted(group, key=lambda t: t['columns'] is None):
+            cols = term['columns'] or list(df.columns)
+            col_idx = [col_positions[col] for col in cols]
+            if mode in ('exact', 'prefix'):
+                mask = index_term_mask(df, candidates, col_idx, term['value'], mode)
+            else:
+                frame = df.iloc[:, col_idx] if candidates is all_rows else df.iloc[candidates, col_idx]
+                mask = parallel_term_mask(frame, term['value'], mode)
+            hits.append((candidates, col_idx, mask))
+            candidates = candidates[mask.any(axis=1)]
+            if not len(candidates):
+                break
+        positions = np.union1d(positions, candidates)
+
+    match = np.zeros((len(positions), len(df.columns)), dtype=bool)
+    for evaluated, col_idx, mask in hits:
+        if not len(evaluated) or not len(positions):
+            continue
+        # Both arrays are sorted: locate result rows among the evaluated rows
+        loc = np.minimum(np.searchsorted(evaluated, positions), len(evaluated) - 1)
+        found = np.flatnonzero(evaluated[loc] == positions)
+        match[np.ix_(found, col_idx)] |= mask[loc[found]]
+    return positions, match
+
 # --- Optimized CSV Search Function Using Caching and Vectorized Operations ---
-def chunk_search_csv(csv_path, search_text):
+def search_cache_key(csv_path, search_text, mode):
+    return (csv_path, os.path.getmtime(csv_path), search_text, mode)
+
+def cache_search_result(key, positions, match):
+    with csv_cache_lock:
+        search_result_cache[key] = (positions, match)
+        search_result_cache.move_to_end(key)
+        while len(search_result_cache) > SEARCH_RESULT_CACHE_SIZE:
+            search_result_cache.popitem(last=False)
+
+def cached_search_result(key):
+    """The (positions, match) stored for key, or None."""
+    with csv_cache_lock:
+        return search_result_cache.get(key)
+
+def pending_search_job(key):
+    """The "first page fast" job still scanning for key, or None."""
+    with state_lock:
+        return next((job for job in search_jobs.values() if job['key'] == key and job['status'] == 'pending'), None)
+
+def search_table(csv_path, search_text, mode='literal'):
+    """
+    Runs a query against the cached table and returns (df, positions, match),
+    reusing the result of an identical completed search when available, or
+    waiting for a "first page fast" search of the same query to finish.
+    """
+    df = load_csv_cached(csv_path)
+    if df.empty:
+        return df, np.empty(0, dtype=np.int64), np.zeros((0, 0), dtype=bool)
+    key = search_cache_key(csv_path, search_text, mode)
+    cached = cached_search_result(key)
+    if cached is None:
+        job = pending_search_job(key)
+        if job is not None:
+            job['future'].result()
+            cached = cached_search_result(key)
+    if cached is not None:
+        return (df,) + cached
+    groups = parse_search_query(search_text, list(df.columns))
+    positions, match = evaluate_search_terms(df, groups, mode)
+    cache_search_result(key, positions, match)
+    return df, positions, match
+
+def chunk_search_csv(csv_path, search_text, mode='literal'):
     """
     Instead of reading in chunks row by row, load the entire CSV using cache
     and use vectorized string operations to improve performance.
+    The query supports column:value terms, AND/OR and "quoted phrases"
+    (see parse_search_query); only referenced columns are scanned.
+    mode is one of SEARCH_MODES: 'literal' substring (no regex), 'exact'
+    and 'prefix' (answered from column indexes) or 'regex'. An invalid
+    regex raises re.error.
     Returns a list of dictionaries with row_index, data (row as dict),
     and matching_columns (list of columns where search_text was found).
     """
+    return result_records(search_result_set(csv_path, search_text, mode))
+
+# --- "First Page Fast" Search ---
+def fast_search_csv(csv_path, search_text, mode, limit):
+    """
+    Scans the table in blocks of FAST_SEARCH_BLOCK_ROWS until `limit` matches
+    are found and returns every match in the scanned blocks at once as
+    (result set, job). That is the complete result when the job is already
+    'done'. If rows are left, the rest of the table is searched on
+    background_executor; the job dict
+    (also registered in search_jobs) then holds an approximate total until
+    its status turns 'done' and the complete result lands in the search cache.
+    A job already scanning the same query is shared rather than started twice.
+    """
     df = load_csv_cached(csv_path)
-    if df.empty:
-        return []
-    # Create a boolean DataFrame where each cell indicates if the cell contains search_text.
-    mask = df.apply(lambda col: col.str.contains(search_text, case=False, na=False))
-    any_match = mask.any(axis=1)
-    matched_indices = df.index[any_match]
-    
-    results = []
-    for idx in matched_indices:
-        row = df.loc[idx]
-        # Determine which columns matched using the precomputed mask.
-        matching_columns = mask.loc[idx][mask.loc[idx]].index.tolist()
-        results.append({
-            'row_index': int(idx),
-            'data': row.to_dict(),
-            'matching_columns': matching_columns
-        })
-    return results
+    key = search_cache_key(csv_path, search_text, mode)
+    groups = parse_search_query(search_text, list(df.columns))
+    parts = []
+    found = 0
+    scanned = 0
+    while scanned < len(df) and found < limit:
+        block = df.iloc[scanned:scanned + FAST_SEARCH_BLOCK_ROWS]
+        positions, match = evaluate_search_terms(block, groups, mode)
+        parts.append((positions + scanned, match))
+        found += len(positions)
+        scanned += len(block)
+
+    positions = np.concatenate([p for p, _ in parts]) if parts else np.empty(0, dtype=np.int64)
+    match = np.vstack([m for _, m in parts]) if parts else np.zeros((0, len(df.columns)), dtype=bool)
+    job = {
+        'id': uuid.uuid4().hex,
+        'key': key,
+        'status': 'pending',
+        'scanned_rows': scanned,
+        'matched_rows': found,
+        'table_rows': len(df)
+    }
+    if scanned >= len(df):
+        cache_search_result(key, positions, match)
+        job['status'] = 'done'
+    else:
+        with state_lock:
+            pending = next((j for j in search_jobs.values() if j['key'] == key and j['status'] == 'pending'), None)
+            if pending is None:
+                search_jobs[job['id']] = job
+                while len(search_jobs) > MAX_SEARCH_JOBS:
+                    search_jobs.popitem(last=False)
+                job['future'] = background_executor.submit(finish_fast_search, job, df, groups, mode, positions, match)
+            else:
+                job = pending
+    return make_result_set(df, positions, match), job
+
+def finish_fast_search(job, df, groups, mode, positions, match):
+    """Searches the rows a fast search skipped and stores the full result."""
+    try:
+        scanned = job['scanned_rows']
+        rest_positions, rest_match = evaluate_search_terms(df.iloc[scanned:], groups, mode)
+        positions = np.concatenate([positions, rest_positions + scanned])
+        match = np.vstack([match, rest_match])
+        cache_search_result(job['key'], positions, match)
+        job.update({'matched_rows': len(positions), 'scanned_rows': len(df), 'status': 'done'})
+    except Exception as e:
+        print(f"Error finishing search {job['id']}: {e}")
+        job.update({'status': 'error', 'error': str(e)})
+
+def search_job_totals(job, rows_per_page):
+    """Total rows/pages of a fast search job; approximate while pending."""
+    if job['status'] == 'done':
+        total_rows = job['matched_rows']
+    else:
+        # Extrapolate the match rate of the scanned blocks to the whole table
+        total_rows = round(job['matched_rows'] * job['table_rows'] / max(job['scanned_rows'], 1))
+    total_pages = max(1, (total_rows + rows_per_page - 1) // rows_per_page)
+    return total_rows, total_pages
 
 # --- Updated AI Response Function ---
 def get_ai_response(search_summary, user_query, last_query):
-    """Enhanced AI response with better error handling and action parsing."""
+    """
+    Enhanced AI response with better error handling and action parsing.
+    Blocks until the model has answered (or AI_TIMEOUT passes); /ai_query
+    runs the same job in the background and streams it instead.
+    """
+    job, error = start_ai_job(search_summary, user_query, last_query)
+    if error is not None:
+        return error
+    with job['cond']:
+        job['cond'].wait_for(lambda: job['status'] != 'running', timeout=AI_TIMEOUT)
+    expire_ai_job(job)
+    return finish_ai_job(job)
+
+# Static part of every AI prompt, built once. It comes first so identical
+# prefixes can be reused across calls; the data context follows it.
+AI_ROLE_PREFIX = (
+    "You are an AI assistant specialized in CSV data analysis. "
+    "Based on the search results described below (the table rows matching the user's search query), you can:\n"
+    "- Provide information about the search results without modifying the table (e.g., total row count, counts of specific data).\n"
+    "- Manipulate the table (e.g., sort, filter, combine columns).\n"
+    "**Instructions:**\n"
+    "- For queries requiring only information (e.g., 'How many search results are there?' or 'How many emails are there?'), respond with the answer in HTML format without a <script> tag.\n"
+    "- For queries requiring table manipulation (e.g., sorting, combining columns), include a JSON-like instruction in a <script type='ai-action'> tag.\n"
+    "**Examples:**\n"
+    "1. Query: 'How many search results are there?' Response: "
+    "<div class='ai-header'>Row Count</div><div class='ai-content'>There are N rows in the search results.</div>\n"
+    "2. Query: 'How many emails are there?' Response: "
+    "<div class='ai-header'>Email Count</div><div class='ai-content'>There are X emails in the search results.</div>\n"
+    "3. Query: 'How many phone numbers are there?' Response: "
+    "<div class='ai-header'>Phone Count</div><div class='ai-content'>There are X phone numbers in columns: Phone1, Phone2.</div>\n"
+    "4. Query: 'Combine all emails containing gmail and name the column header \"EMAIL SHEETS\"' Response: "
+    "<div class='ai-header'>Combining Emails</div><div class='ai-content'>A new column \"EMAIL SHEETS\" has been added with emails containing \"gmail\".</div>"
+    "<script type='ai-action'>{\"action\": \"combine\", \"column\": \"email\", \"condition\": \"contains gmail\", \"new_column\": \"EMAIL SHEETS\"}</script>\n"
+    "5. Query: 'Remove all email headers, combine them, and put them into \"email ko\" column' Response: "
+    "<div class='ai-header'>Merging Emails</div><div class='ai-content'>Combined all email columns into \"email ko\".</div>"
+    "<script type='ai-action'>{\"action\": \"merge\", \"columns\": [\"Email1\", \"Email2\", \"Email3\", \"Email4\", \"Email5\"], \"new_column\": \"email ko\"}</script>\n"
+    "6. Query: 'How many ahmed that name starts with letter J' Response: Check for 'name' column; if absent, suggest alternatives.\n"
+    "**Condition Format for Actions:** Use 'column contains value' or 'column is not empty'.\n"
+    "Ensure column names match those listed for the table.\n"
+    "Respond in HTML with <div class='ai-header'> and <div class='ai-content'> tags."
+)
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token) used for the prompt budget."""
+    return len(text) // PROMPT_CHARS_PER_TOKEN + 1
+
+def rank_prompt_columns(columns, user_query, last_query, result_set=None, profile=None):
+    """
+    Columns ordered by relevance to the question: named in the question or
+    search first, then columns the search matched in, then informative
+    (non-constant, mostly filled) columns. Ties keep table order.
+    """
+    words = {singular(word) for word in re.findall(r'\w+', f"{user_query} {last_query}".lower()) if len(word) > 2}
+    matched = set()
+    if result_set is not None and result_set['match'].size:
+        hits = result_set['match'].any(axis=0)
+        matched = {column for column, hit in zip(result_set['match_columns'], hits) if hit}
+
+    def score(column):
+        name = column.lower()
+        stats = profile['columns'].get(column) if profile is not None else None
+        if stats is not None:
+            filled = 1 - (stats['empty'] + stats['nulls']) / max(profile['rows'], 1)
+            informative = stats['distinct'] > 1
+        else:
+            filled, informative = 0.5, True
+        return (any(word in name for word in words), column in matched, informative, filled)
+
+    return sorted(columns, key=score, reverse=True)
+
+def sample_result_positions(result_set, count, seed):
+    """
+    Stratified sample of count rows spread over the whole result set: the
+    rows are cut into count equal strata and one row is drawn from each.
+    """
+    positions = result_set['positions']
+    if len(positions) <= count:
+        return np.arange(len(positions))
+    edges = np.linspace(0, len(positions), count + 1).astype(np.int64)
+    rng = np.random.default_rng(seed)
+    return rng.integers(edges[:-1], edges[1:])
+
+def build_ai_prompt(user_query, last_query, search_summary, result_set=None, profile=None):
+    """
+    Builds the prompt within AI_PROMPT_TOKEN_BUDGET: the static role prefix,
+    the search context, profile lines for the most relevant columns, and rows
+    sampled across the whole result set (or search_summary's sample rows
+    when there is no result set), each section cut off when the budget runs out.
+    """
+    if result_set is not None:
+        columns = result_set['columns']
+        num_rows = len(result_set['positions'])
+    else:
+        columns = search_summary['columns']
+        num_rows = search_summary['num_rows']
+    ranked = rank_prompt_columns(columns, user_query, last_query, result_set, profile)
+    budget = AI_PROMPT_TOKEN_BUDGET - estimate_tokens(AI_ROLE_PREFIX) - estimate_tokens(user_query) - 20
+
+    column_list = ', '.join(columns)
+    if estimate_tokens(column_list) > budget // 4:
+        # Very wide table: list the most relevant names only
+        shown = []
+        for column in ranked:
+            if estimate_tokens(', '.join(shown + [column])) > budget // 4:
+                break
+            shown.append(column)
+        column_list = f"{', '.join(shown)} (and {len(columns) - len(shown)} more)"
+    context = (
+        f"Search query: '{last_query}' (searched across all columns)\n"
+        f"Search results:\n- Columns: {column_list}\n- Rows: {num_rows}\n"
+    )
+    budget -= estimate_tokens(context)
+
+    if profile is not None:
+        lines = []
+        for line in profile_prompt_text(profile, ranked[:PROMPT_MAX_COLUMNS]).split('\n'):
+            if not line or estimate_tokens(line) > budget // 2:
+                break
+            lines.append(line)
+            budget -= estimate_tokens(line)
+        if lines:
+            context += f"Column profile of the whole file ({profile['rows']} rows):\n" + '\n'.join(lines) + '\n'
+
+    sample_columns = ranked[:PROMPT_MAX_COLUMNS]
+    if result_set is not None:
+        picks = sample_result_positions(result_set, PROMPT_SAMPLE_ROWS, zlib.crc32(f"{last_query}:{num_rows}".encode('utf-8')))
+        frame = result_set['df'].iloc[result_set['positions'][picks]][sample_columns]
+        frame = frame.astype(object).where(frame.notna(), '')
+        rows = list(zip(frame.index, frame.to_dict('records')))
+    else:
+        rows = [(row.get('row_index', 'N/A'), {k: v for k, v in row.items() if k in sample_columns})
+                for row in search_summary['sample_rows']]
+    sample_lines = []
+    for i, (row_index, row) in enumerate(rows):
+        values = ", ".join(f"{k}={str(v)[:PROMPT_VALUE_CHARS]}" for k, v in row.items() if str(v).strip())
+        line = f"Row {i+1} (Index {row_index}): {values}"
+        if estimate_tokens(line) > budget:
+            break
+        sample_lines.append(line)
+        budget -= estimate_tokens(line)
+    context += f"Sample ({len(sample_lines)} rows spread over the results):\n" + '\n'.join(sample_lines) + '\n'
+    return f"{AI_ROLE_PREFIX}\n\n{context}\nUser query: {user_query}"
+
+def format_ai_response(response_text):
+    """Cleans up model output into the HTML shown in the AI panel."""
+    # Enhanced response cleaning and formatting
+    response_text = re.sub(r'^```html\s*\n', '', response_text, flags=re.MULTILINE)
+    response_text = re.sub(r'\n```$', '', response_text, flags=re.MULTILINE)
+
+    # Standardize action script formatting
+    script_start = response_text.find("<script type='ai-action'>")
+    script_end = response_text.find("</script>", script_start) + 9 if script_start != -1 else -1
+
+    if script_start != -1 and script_end != -1:
+        # Extract and validate action script
+        script_content = response_text[script_start:script_end]
+        try:
+            action = json.loads(script_content[script_content.find('>')+1:script_content.rfind('<')].strip())
+            if not isinstance(action, dict) or 'action' not in action:
+                script_content = ""
+        except json.JSONDecodeError:
+            script_content = ""
+
+        # Format response with consistent spacing
+        before_script = response_text[:script_start].strip()
+        after_script = response_text[script_end:].strip()
+
+        response_text = f"{before_script}\n\n{script_content}\n\n{after_script}"
+
+    # Standardize line breaks and spacing
+    response_text = response_text.replace('\n\n', '<br><br>')
+    return response_text.replace('\n', '<br>')
+
+def chat_history_html(chat_history):
+    chat_html = ''
+    for entry in chat_history:
+        chat_html += (
+            f'<details class="chat-entry" data-id="{entry["id"]}" data-query="{entry["query"].lower()}">'
+            f'<summary><span>{entry["query"]}</span><button class="delete-chat" onclick="deleteChatEntry({entry["id"]})">Delete</button></summary>'
+            f'<div class="chat-timestamp">{entry["timestamp"]}</div>'
+            f'<p>{entry["response"]}</p>'
+            '</details>'
+        )
+    return chat_html
+
+# --- Local Answers for Simple Questions ---
+# Counting questions ("how many rows/emails?", "how many unique cities?",
+# "top 5 values in country") are answered exactly from the full result set
+# instead of asking the model, which only sees a few sample rows. Anything
+# not recognized here falls through to the model.
+LOCAL_ROW_COUNT_PATTERN = re.compile(
+    r'^(?:how many|count(?: of)?|number of|total(?: number of)?)\s+(?:the\s+)?'
+    r'(?:rows|results|records|entries|matches)(?:\s+(?:are there|in (?:the )?(?:results|table)))?$'
+    r'|^how many are there$'
+)
+LOCAL_UNIQUE_PATTERN = re.compile(r'^(?:how many|count(?: of)?|number of)\s+(?:the\s+)?(?:unique|distinct|different)\s+(?P<term>.+?)(?:\s+are there)?$')
+LOCAL_TOP_PATTERN = re.compile(
+    r'^(?:what are |show )?(?:the\s+)?(?:top|most common|most frequent)\s*(?P<n>\d+)?\s+'
+    r'(?:values\s+)?(?:(?:in|of|for)\s+)?(?:the\s+)?(?P<term>.+?)(?:\s+values)?$'
+)
+LOCAL_COUNT_PATTERN = re.compile(r'^(?:how many|count(?: of)?|number of)\s+(?:the\s+)?(?:non-empty\s+)?(?P<term>.+?)(?:\s+are there|\s+are not empty|\s+values)?$')
+# Words that may follow a column name without naming a column themselves
+LOCAL_TERM_FILLERS = {'number', 'numbers', 'address', 'addresses', 'value', 'values', 'field', 'fields', 'column', 'columns'}
+LOCAL_TOP_DEFAULT = 5
+
+def singular(word):
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+def match_term_columns(term, columns):
+    """
+    Columns a short question term refers to ('emails' -> every column with
+    'email' in its name), or [] when the term isn't clearly about columns.
+    """
+    lowered = {column: column.lower() for column in columns}
+    exact = [column for column in columns if lowered[column] in (term, singular(term))]
+    if exact:
+        return exact
+    words = re.findall(r'\w+', term)
+    if not words or len(words) > 3:
+        return []
+    matched = []
+    for word in words:
+        hits = [column for column in columns if singular(word) in lowered[column]]
+        if not hits and word not in LOCAL_TERM_FILLERS:
+            return []  # An unknown word: leave the question to the model
+        matched.extend(column for column in hits if column not in matched)
+    return matched
+
+def column_values(result_set, columns):
+    """Non-empty, stripped values of columns over the whole result set, stacked."""
+    frame = result_set['df'].iloc[result_set['positions']][columns]
+    stacked = pd.concat([frame[column].astype(object) for column in columns], keys=columns)
+    stacked = stacked.where(stacked.notna(), '').astype(str).str.strip()
+    return stacked[stacked != '']
+
+def local_ai_answer(user_query, result_set):
+    """
+    The answer HTML for a counting question about result_set, computed
+    locally, or None when the question needs the model.
+    """
+    query = ' '.join(user_query.lower().split()).rstrip('?!. ')
+    columns = result_set['columns']
+    num_rows = len(result_set['positions'])
+
+    if LOCAL_ROW_COUNT_PATTERN.match(query):
+        return ("<div class='ai-header'>Row Count</div>"
+                f"<div class='ai-content'>There are {num_rows} rows in the search results.</div>")
+
+    found = LOCAL_UNIQUE_PATTERN.match(query)
+    if found:
+        matched = match_term_columns(found.group('term'), columns)
+        if not matched:
+            return None
+        distinct = column_values(result_set, matched).nunique()
+        return ("<div class='ai-header'>Distinct Values</div>"
+                f"<div class='ai-content'>There are {distinct} distinct values in "
+                f"{escape(', '.join(matched))}.</div>")
+
+    found = LOCAL_TOP_PATTERN.match(query)
+    if found:
+        matched = match_term_columns(found.group('term'), columns)
+        if not matched:
+            return None
+        top = column_values(result_set, matched).value_counts().head(int(found.group('n') or LOCAL_TOP_DEFAULT))
+        items = ''.join(f"<li>{escape(str(value))}: {count}</li>" for value, count in top.items())
+        return ("<div class='ai-header'>Most Common Values</div>"
+                f"<div class='ai-content'>Most common values in {escape(', '.join(matched))}:<ol>{items}</ol></div>")
+
+    found = LOCAL_COUNT_PATTERN.match(query)
+    if found:
+        matched = match_term_columns(found.group('term'), columns)
+        if not matched:
+            return None
+        values = column_values(result_set, matched)
+        per_column = values.groupby(level=0, sort=False).size().reindex(matched, fill_value=0)
+        breakdown = ', '.join(f"{escape(column)}: {count}" for column, count in per_column.items())
+        return (f"<div class='ai-header'>{escape(found.group('term').title())} Count</div>"
+                f"<div class='ai-content'>There are {len(values)} non-empty values "
+                f"({values.nunique()} distinct) in the search results ({breakdown}).</div>")
+    return None
+
+# --- AI Response Cache ---
+def ai_cache_key(model, user_query, input_text):
+    """
+    Key of an answer: the model, the normalized question and a hash of the
+    data part of the prompt (search context, profile and sampled rows), so a
+    filter, sort or undo that changes what the model sees changes the key.
+    """
+    normalized_query = ' '.join(user_query.lower().split()).rstrip('?!. ')
+    data_text = input_text.rsplit('\nUser query: ', 1)[0]
+    fingerprint = [model, normalized_query, hashlib.sha256(data_text.encode('utf-8')).hexdigest()]
+    return hashlib.sha256(json.dumps(fingerprint).encode('utf-8')).hexdigest()
+
+def cached_ai_response(key):
+    """The cached answer text for key, or None; counts the hit or miss."""
+    response_text = ai_response_cache.get(key)
+    with state_lock:
+        ai_cache_counts['hits' if response_text is not None else 'misses'] += 1
+    return response_text
+
+def ai_cache_report():
+    with state_lock:
+        hits, misses = ai_cache_counts['hits'], ai_cache_counts['misses']
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        'ttl_seconds': AI_CACHE_TTL,
+        'max_entries': AI_CACHE_SIZE
+    }
+
+# --- Background AI Jobs ---
+# /ai_query only validates the request and submits the model call to
+# ai_executor, so a slow model never holds a request thread. The page follows
+# the job over /ai_stream (Server-Sent Events, one event per streamed chunk)
+# and fetches the final HTML from /ai_result; /ai_cancel abandons it.
+def start_ai_job(search_summary, user_query, last_query, use_cache=True, batch=False):
+    """
+    Validates the request and submits the model call; returns (job, None) or
+    (None, error result). A question answered locally or from the cache
+    gives a job that is already done (job['source'] says which). batch=True
+    asks the question over every row of the result set (see run_ai_batch_job).
+    """
     # Validate inputs first
     if not isinstance(search_summary, dict) or not all(k in search_summary for k in ['columns', 'num_rows', 'sample_rows']):
-        return {
+        return None, {
             "response": "<div class='ai-error'><div class='ai-header'>Error</div><div class='ai-content'>Invalid search summary format</div></div>",
             "action": None,
             "chat_html": ""
         }
-    
+
+    pipeline = current_pipeline() if has_request_context() else None
+    result_set = pipeline_result(pipeline) if pipeline is not None else None
+    response_text = local_ai_answer(user_query, result_set) if result_set is not None else None
+    if response_text is not None:
+        return new_ai_job(user_query, None, 'local', response_text), None
+
     api_key = session.get('api_key')
     model = session.get('model', 'gemini-2.0-flash-thinking-exp-01-21')
     if not api_key:
-        return {
+        return None, {
             "response": "<div class='ai-error'><div class='ai-header'>Error</div><div class='ai-content'>API key not set. Please configure it in Settings.</div></div>",
             "action": None,
             "chat_html": ""
         }
-    
+
     if search_summary['num_rows'] == 0:
-        return {
+        return None, {
             "response": "<div class='ai-info'><div class='ai-header'>Information</div><div class='ai-content'>No search results to analyze.</div></div>",
             "action": None,
             "chat_html": ""
         }
 
-    columns = search_summary['columns']
-    num_rows = search_summary['num_rows']
-    sample_rows = search_summary['sample_rows']
-    
-    sample_text = ""
-    for i, row in enumerate(sample_rows):
-        row_info = f"Row {i+1} (Index {row.get('row_index', 'N/A')}): "
-        row_info += ", ".join([f"{k}={v}" for k, v in row.items() if k != 'row_index'])
-        sample_text += row_info + "\n"
-
-    ai_role = (
-        f"You are an AI assistant specialized in CSV data analysis. "
-        f"Based on the search results (searched across all columns with query '{last_query}'), you can:\n"
-        "- Provide information about the search results without modifying the table (e.g., total row count, counts of specific data).\n"
-        "- Manipulate the table (e.g., sort, filter, combine columns).\n"
-        "**Instructions:**\n"
-        "- For queries requiring only information (e.g., 'How many are there on search results containing {last_query}?' or 'How many emails are there?'), respond with the answer in HTML format without a <script> tag.\n"
-        "- For queries requiring table manipulation (e.g., sorting, combining columns), include a JSON-like instruction in a <script type='ai-action'> tag.\n"
-        "**Examples:**\n"
-        "1. Query: 'How many are there on search results containing {last_query}?' Response: "
-        "<div class='ai-header'>Row Count</div><div class='ai-content'>There are {num_rows} rows in the search results.</div>\n"
-        "2. Query: 'How many emails are there?' Response: "
-        "<div class='ai-header'>Email Count</div><div class='ai-content'>There are X emails in the search results.</div>\n"
-        "3. Query: 'How many phone numbers are there?' Response: "
-        "<div class='ai-header'>Phone Count</div><div class='ai-content'>There are X phone numbers in columns: {', '.join([c for c in columns if 'phone' in c.lower()])}.</div>\n"
-        "3. Query: 'Combine all emails containing {last_query} and name the column header \"EMAIL SHEETS\"' Response: "
-        "<div class='ai-header'>Combining Emails</div><div class='ai-content'>A new column \"EMAIL SHEETS\" has been added with emails containing \"{last_query}\".</div>"
-        "<script type='ai-action'>{{\"action\": \"combine\", \"column\": \"email\", \"condition\": \"contains {last_query}\", \"new_column\": \"EMAIL SHEETS\"}}</script>\n"
-        "4. Query: 'Remove all email headers, combine them, and put them into \"email ko\" column' Response: "
-        "<div class='ai-header'>Merging Emails</div><div class='ai-content'>Combined all email columns into \"email ko\".</div>"
-        "<script type='ai-action'>{{\"action\": \"merge\", \"columns\": [\"Email1\", \"Email2\", \"Email3\", \"Email4\", \"Email5\"], \"new_column\": \"email ko\"}}</script>\n"
-        "5. Query: 'How many ahmed that name starts with letter J' Response: Check for 'name' column; if absent, suggest alternatives.\n"
-        "**Condition Format for Actions:** Use 'column contains value' or 'column is not empty'.\n"
-        "Ensure column names match those in the table: {', '.join(columns)}.\n"
-        "Respond in HTML with <div class='ai-header'> and <div class='ai-content'> tags."
-    )
-    summary = (
-        f"Search results:\n- Columns: {', '.join(columns)}\n- Rows: {num_rows}\n"
-        f"Sample:\n{sample_text}"
-    )
-    input_text = f"{ai_role}\n\n{summary}\n\nUser query: {user_query}"
+    csv_path = session.get('csv_path', DEFAULT_CSV_PATH) if has_request_context() else None
+    # Only a finished profile is used; the model call doesn't wait for one
+    profile = get_table_profile(csv_path, wait=False) if csv_path and os.path.exists(csv_path) else None
+    if batch:
+        if result_set is None:
+            return None, {
+                "response": "<div class='ai-error'><div class='ai-header'>Error</div><div class='ai-content'>No search results to analyze.</div></div>",
+                "action": None,
+                "chat_html": ""
+            }
+        job = new_ai_job(user_query, None, 'batch', timeout=AI_BATCH_TIMEOUT)
+        job['future'] = ai_batch_job_executor.submit(run_ai_batch_job, job, api_key, model, user_query, last_query, result_set, profile)
+        return job, None
+    input_text = build_ai_prompt(user_query, last_query, search_summary, result_set, profile)
+    cache_key = ai_cache_key(model, user_query, input_text)
+    response_text = cached_ai_response(cache_key) if use_cache else None
+    if response_text is not None:
+        return new_ai_job(user_query, cache_key, 'cache', response_text), None
+    job = new_ai_job(user_query, cache_key, 'model')
+    job['future'] = ai_executor.submit(run_ai_job, job, api_key, model, input_text)
+    return job, None
+
+def new_ai_job(user_query, cache_key, source, response_text=None, timeout=None):
+    """Registers a job; with response_text it starts out done."""
+    timeout = AI_TIMEOUT if timeout is None else timeout
+    job = {
+        'id': uuid.uuid4().hex,
+        'query': user_query,
+        'status': 'running' if response_text is None else 'done',
+        'chunks': [] if response_text is None else [response_text],
+        'error': None,
+        'deadline': time.monotonic() + timeout,
+        'timeout': timeout,
+        'progress': None,
+        'cond': threading.Condition(),
+        'result': None,
+        'cache_key': cache_key,
+        'source': source  # 'model', 'batch', 'cache' or 'local'
+    }
+    with state_lock:
+        ai_jobs[job['id']] = job
+        while len(ai_jobs) > MAX_AI_JOBS:
+            _, evicted = ai_jobs.popitem(last=False)
+            cancel_ai_job(evicted)
+    return job
 
+def run_ai_job(job, api_key, model, input_text):
+    """Streams the model answer into job['chunks'] until done, cancelled or timed out."""
     try:
-        genai.configure(api_key=api_key)
-        model_instance = genai.GenerativeModel(model)
-        response = model_instance.generate_content(input_text)
-        response_text = response.text
-        
-        # Enhanced response cleaning and formatting
-        response_text = re.sub(r'^```html\s*\n', '', response_text, flags=re.MULTILINE)
-        response_text = re.sub(r'\n```$', '', response_text, flags=re.MULTILINE)
-        
-        # Standardize action script formatting
-        script_start = response_text.find("<script type='ai-action'>")
-        script_end = response_text.find("</script>", script_start) + 9 if script_start != -1 else -1
-        
-        if script_start != -1 and script_end != -1:
-            # Extract and validate action script
-            script_content = response_text[script_start:script_end]
-            try:
-                action = json.loads(script_content[script_content.find('>')+1:script_content.rfind('<')].strip())
-                if not isinstance(action, dict) or 'action' not in action:
-                    script_content = ""
-            except json.JSONDecodeError:
-                script_content = ""
-                
-            # Format response with consistent spacing
-            before_script = response_text[:script_start].strip()
-            after_script = response_text[script_end:].strip()
-            
-            response_text = f"{before_script}\n\n{script_content}\n\n{after_script}"
-        
-        # Standardize line breaks and spacing
-        response_text = response_text.replace('\n\n', '<br><br>')
-        response_text = response_text.replace('\n', '<br>')
-
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        formatted_response = (
-            "<div class='ai-message'>"
-            f"<div class='ai-timestamp'>{timestamp}</div>"
-            f"{response_text}"
-            "</div>"
-        )
-        chat_history = session.get('chat_history', persistent_chat_history)
-        chat_entry = {
-            "id": len(chat_history) + 1,
-            "query": user_query,
-            "response": response.text,
-            "timestamp": timestamp
-        }
-        chat_history.append(chat_entry)
-        session['chat_history'] = chat_history
-        save_chat_history(chat_history)
-
-        chat_html = ''
-        for entry in chat_history:
-            chat_html += (
-                f'<details class="chat-entry" data-id="{entry["id"]}" data-query="{entry["query"].lower()}">'
-                f'<summary><span>{entry["query"]}</span><button class="delete-chat" onclick="deleteChatEntry({entry["id"]})">Delete</button></summary>'
-                f'<div class="chat-timestamp">{entry["timestamp"]}</div>'
-                f'<p>{entry["response"]}</p>'
-                '</details>'
-            )
+        for text in stream_model_response(api_key, model, input_text, AI_TIMEOUT):
+            with job['cond']:
+                if job['status'] != 'running':
+                    return  # Cancelled (or expired): drop the rest of the answer
+                if time.monotonic() > job['deadline']:
+                    job.update({'status': 'error', 'error': f"The model did not answer within {job['timeout']:g} seconds"})
+                    job['cond'].notify_all()
+                    return
+                job['chunks'].append(text)
+                job['cond'].notify_all()
+        with job['cond']:
+            if job['status'] != 'running':
+                return
+            job['status'] = 'done'
+            job['cond'].notify_all()
+            response_text = ''.join(job['chunks'])
+        if response_text.strip():
+            ai_response_cache.set(job['cache_key'], response_text)
+    except Exception as e:
+        print(f"Error in AI job {job['id']}: {e}")
+        with job['cond']:
+            if job['status'] == 'running':
+                job.update({'status': 'error', 'error': str(e)})
+                job['cond'].notify_all()
+
+def stream_model_response(api_key, model, input_text, timeout):
+    """
+    Yields the model's answer in chunks. With CSV_AI_ENDPOINT set, calls that
+    server's Gemini REST streamGenerateContent API (e.g. a local stub model
+    server) instead of Google's.
+    """
+    if AI_ENDPOINT:
+        url = f"{AI_ENDPOINT.rstrip('/')}/v1beta/models/{model}:streamGenerateContent?alt=sse"
+        body = json.dumps({'contents': [{'role': 'user', 'parts': [{'text': input_text}]}]}).encode('utf-8')
+        req = urllib.request.Request(url, data=body, headers={
+            'Content-Type': 'application/json',
+            'x-goog-api-key': api_key
+        })
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            for line in response:
+                line = line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                payload = json.loads(line[5:])
+                for candidate in payload.get('candidates', [])[:1]:
+                    text = ''.join(part.get('text', '') for part in candidate.get('content', {}).get('parts', []))
+                    if text:
+                        yield text
+        return
+    request = glm.GenerateContentRequest(
+        model=model if model.startswith(('models/', 'tunedModels/')) else f"models/{model}",
+        contents=[glm.Content(role='user', parts=[glm.Part(text=input_text)])]
+    )
+    for chunk in model_client(api_key).stream_generate_content(request, timeout=timeout):
+        for candidate in chunk.candidates[:1]:
+            text = ''.join(part.text for part in candidate.content.parts)
+            if text:
+                yield text
+
+def model_client(api_key):
+    """The Gemini client for api_key; clients are thread-safe and reused."""
+    with ai_clients_lock:
+        client = ai_clients.get(api_key)
+        if client is None:
+            client = glm.GenerativeServiceClient(client_options={'api_key': api_key})
+            ai_clients[api_key] = client
+            while len(ai_clients) > MAX_AI_CLIENTS:
+                ai_clients.popitem(last=False)
+        else:
+            ai_clients.move_to_end(api_key)
+        return client
+
+def expire_ai_job(job):
+    """Fails a job that is still running past its deadline."""
+    with job['cond']:
+        if job['status'] == 'running' and time.monotonic() > job['deadline']:
+            job.update({'status': 'error', 'error': f"The model did not answer within {job['timeout']:g} seconds"})
+            job['cond'].notify_all()
 
+def cancel_ai_job(job):
+    with job['cond']:
+        if job['status'] == 'running':
+            job['status'] = 'cancelled'
+            job['cond'].notify_all()
+    if job.get('future') is not None:
+        job['future'].cancel()
+
+def get_ai_job(job_id):
+    with state_lock:
+        return ai_jobs.get(job_id)
+
+def iter_ai_events(job):
+    """
+    Server-Sent Events for a job: a 'chunk' per streamed piece of text (and
+    'progress' as a batch job works through its chunks), then 'done' or 'error'.
+    """
+    sent = 0
+    progress = None
+    while True:
+        with job['cond']:
+            job['cond'].wait_for(lambda: len(job['chunks']) > sent or job['status'] != 'running'
+                                 or job['progress'] != progress, timeout=AI_STREAM_KEEPALIVE)
+            chunks = job['chunks'][sent:]
+            status = job['status']
+            error = job['error']
+            changed = job['progress'] != progress
+            progress = job['progress']
+        if changed:
+            yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+        for text in chunks:
+            yield f"event: chunk\ndata: {json.dumps(text)}\n\n"
+        sent += len(chunks)
+        if status == 'running':
+            expire_ai_job(job)
+            if not chunks and not changed:
+                yield ": keep-alive\n\n"
+            continue
+        if status == 'done':
+            yield "event: done\ndata: {}\n\n"
+        else:
+            yield f"event: error\ndata: {json.dumps(error or status)}\n\n"
+        return
+
+def finish_ai_job(job):
+    """Formats a finished job and records it in the chat history (once)."""
+    with job['cond']:
+        status = job['status']
+        response_text = ''.join(job['chunks'])
+        error = job['error']
+    if status == 'running':
+        return {"response": None, "action": None, "chat_html": "", "pending": True}
+    if job['result'] is not None:
+        return job['result']
+    if status == 'cancelled':
         return {
-            "response": formatted_response,
+            "response": "<div class='ai-info'><div class='ai-header'>Cancelled</div><div class='ai-content'>The AI query was cancelled.</div></div>",
             "action": None,
-            "chat_html": chat_html
+            "chat_html": ""
         }
-    except Exception as e:
+    if status == 'error':
         error_response = (
             "<div class='ai-error'><div class='ai-header'>Error</div>"
-            "<div class='ai-content'>An error occurred: " + str(e) + "</div></div>"
+            "<div class='ai-content'>An error occurred: " + str(error) + "</div></div>"
         )
         return {
             "response": error_response,
@@ -319,273 +1870,583 @@ def get_ai_response(search_summary, user_query, last_query):
             "chat_html": ""
         }
 
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    formatted_response = (
+        "<div class='ai-message'>"
+        f"<div class='ai-timestamp'>{timestamp}</div>"
+        f"{format_ai_response(response_text)}"
+        "</div>"
+    )
+    add_chat_entry(job['query'], response_text, timestamp)
+    chat_history, _, chat_total_pages = chat_history_page()
+    job['result'] = {
+        "response": formatted_response,
+        "action": None,
+        "chat_html": chat_history_html(chat_history),
+        "chat_total_pages": chat_total_pages
+    }
+    return job['result']
+
+# --- Batched AI Over Whole Result Sets ---
+AI_BATCH_MAP_PREFIX = (
+    "You are an AI assistant specialized in CSV data analysis. You are given one chunk of the rows "
+    "matching the user's search, one row per line as 'Index N: column=value, ...'. Answer the user's "
+    "question for these rows only, as plain text without HTML. Be concise: when the question is about "
+    "individual rows, answer with one 'Index N: result' line per row; otherwise give the counts, totals "
+    "or findings for this chunk so they can be combined with the other chunks."
+)
+AI_BATCH_COMBINE_PREFIX = (
+    "You are an AI assistant specialized in CSV data analysis. Below are partial answers to the user's "
+    "question, each computed over a different chunk of the rows matching the search. Combine them into "
+    "one answer covering all of them: add up counts and totals, merge lists and keep per-row lines. "
+    "Answer as plain text without HTML."
+)
+AI_BATCH_REDUCE_PREFIX = (
+    "You are an AI assistant specialized in CSV data analysis. Below are partial answers to the user's "
+    "question, each computed over a different chunk of the rows matching the search; together they cover "
+    "every matching row. Combine them into one final answer: add up counts and totals, merge lists and "
+    "keep per-row results. Respond in HTML with <div class='ai-header'> and <div class='ai-content'> tags."
+)
+
+def iter_batch_chunks(result_set, columns, budget):
+    """Yields the rows of result_set as text chunks of at most ~budget tokens."""
+    lines = []
+    used = 0
+    num_rows = len(result_set['positions'])
+    for start in range(0, num_rows, EXPORT_BATCH_ROWS):
+        frame = result_set['df'].iloc[result_set['positions'][start:start + EXPORT_BATCH_ROWS]][columns]
+        frame = frame.astype(object).where(frame.notna(), '')
+        for row_index, row in zip(frame.index, frame.to_dict('records')):
+            values = ", ".join(f"{k}={str(v)[:PROMPT_VALUE_CHARS]}" for k, v in row.items() if str(v).strip())
+            line = f"Index {row_index}: {values}"
+            cost = estimate_tokens(line)
+            if lines and used + cost > budget:
+                yield '\n'.join(lines)
+                lines, used = [], 0
+            lines.append(line)
+            used += cost
+    if lines:
+        yield '\n'.join(lines)
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retrying a failed model call, or None if it shouldn't be retried."""
+    backoff = min(AI_BATCH_BACKOFF * 2 ** attempt, AI_BATCH_MAX_BACKOFF) * (0.5 + random.random())
+    if isinstance(error, urllib.error.HTTPError):
+        if error.code != 429 and error.code < 500:
+            return None
+        retry_after = error.headers.get('Retry-After', '') if error.headers else ''
+        return min(float(retry_after), AI_BATCH_MAX_BACKOFF) if retry_after.replace('.', '', 1).isdigit() else backoff
+    if isinstance(error, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted,
+                          google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+                          google_exceptions.DeadlineExceeded, urllib.error.URLError, TimeoutError, ConnectionError)):
+        return backoff
+    return None
+
+def call_model_with_retry(job, api_key, model, input_text):
+    """The model's full answer to input_text, retried with backoff on rate limits and transient errors."""
+    for attempt in range(AI_BATCH_RETRIES + 1):
+        try:
+            return ''.join(stream_model_response(api_key, model, input_text, AI_TIMEOUT))
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt == AI_BATCH_RETRIES:
+                raise
+            print(f"AI job {job['id']}: retrying in {delay:.1f}s after {e}")
+            with job['cond']:
+                # Wake up early if the job is cancelled meanwhile
+                if job['cond'].wait_for(lambda: job['status'] != 'running', timeout=delay):
+                    raise RuntimeError('AI job is no longer running')
+
+def map_batch_chunk(job, api_key, model, user_query, chunk):
+    if job['status'] != 'running':
+        return None
+    input_text = f"{AI_BATCH_MAP_PREFIX}\n\nRows:\n{chunk}\n\nUser query: {user_query}"
+    return call_model_with_retry(job, api_key, model, input_text)
+
+def run_model_calls(job, calls):
+    """
+    Runs calls (tuples of a function and its arguments) on ai_batch_executor
+    and returns the answers in order; progress is counted in job['progress'].
+    calls may be a generator: it is consumed as workers free up, so only
+    about 2 * AI_BATCH_CONCURRENCY calls are held at once, and the progress
+    total is filled in once it runs out. Returns None once the job stops running.
+    """
+    calls = iter(calls)
+    futures = {}
+    answers = []
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(futures) < 2 * AI_BATCH_CONCURRENCY:
+                call = next(calls, None)
+                if call is None:
+                    exhausted = True
+                    with job['cond']:
+                        job['progress'] = dict(job['progress'], total=len(answers))
+                        job['cond'].notify_all()
+                    break
+                futures[ai_batch_executor.submit(*call)] = len(answers)
+                answers.append(None)
+            if not futures:
+                return answers
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                answers[futures.pop(future)] = future.result()
+                with job['cond']:
+                    if job['status'] != 'running':
+                        return None
+                    job['progress'] = dict(job['progress'], done=job['progress']['done'] + 1)
+                    job['cond'].notify_all()
+    finally:
+        for future in futures:
+            future.cancel()
+
+def run_ai_batch_job(job, api_key, model, user_query, last_query, result_set, profile):
+    """
+    Map-reduce over the whole result set: each chunk of rows (sized to the
+    prompt budget) is sent with the question, AI_BATCH_CONCURRENCY calls at a
+    time, then the partial answers are combined, in rounds if they don't fit
+    one prompt, into the final answer.
+    """
+    try:
+        columns = rank_prompt_columns(result_set['columns'], user_query, last_query, result_set, profile)[:PROMPT_MAX_COLUMNS]
+        budget = AI_PROMPT_TOKEN_BUDGET - estimate_tokens(AI_BATCH_MAP_PREFIX) - estimate_tokens(user_query) - 20
+        with job['cond']:
+            job['progress'] = {'stage': 'map', 'done': 0, 'total': None}
+            job['cond'].notify_all()
+        answers = run_model_calls(job, ((map_batch_chunk, job, api_key, model, user_query, chunk)
+                                        for chunk in iter_batch_chunks(result_set, columns, budget)))
+
+        budget = AI_PROMPT_TOKEN_BUDGET - estimate_tokens(AI_BATCH_REDUCE_PREFIX) - estimate_tokens(user_query) - 20
+        while answers is not None and sum(estimate_tokens(answer) for answer in answers) > budget:
+            # Too much for one prompt: combine neighbouring answers first
+            groups = [[]]
+            for answer in answers:
+                if groups[-1] and estimate_tokens('\n\n'.join(groups[-1] + [answer])) > budget:
+                    groups.append([])
+                groups[-1].append(answer[:budget * PROMPT_CHARS_PER_TOKEN])
+            if len(groups) == len(answers):
+                answers = [answer[:budget * PROMPT_CHARS_PER_TOKEN // len(answers)] for answer in answers]
+                break
+            with job['cond']:
+                job['progress'] = {'stage': 'combine', 'done': 0, 'total': len(groups)}
+                job['cond'].notify_all()
+            answers = run_model_calls(job, [
+                (call_model_with_retry, job, api_key, model, batch_combine_prompt(AI_BATCH_COMBINE_PREFIX, group, user_query))
+                for group in groups
+            ])
+        if answers is None:
+            return
+        with job['cond']:
+            job['progress'] = {'stage': 'reduce', 'done': 0, 'total': 1}
+            job['cond'].notify_all()
+        final = call_model_with_retry(job, api_key, model, batch_combine_prompt(AI_BATCH_REDUCE_PREFIX, answers, user_query))
+        with job['cond']:
+            if job['status'] != 'running':
+                return
+            job['chunks'].append(final)
+            job['progress'] = dict(job['progress'], done=1)
+            job['status'] = 'done'
+            job['cond'].notify_all()
+    except Exception as e:
+        print(f"Error in AI batch job {job['id']}: {e}")
+        with job['cond']:
+            if job['status'] == 'running':
+                job.update({'status': 'error', 'error': str(e)})
+                job['cond'].notify_all()
+
+def batch_combine_prompt(prefix, answers, user_query):
+    parts = '\n\n'.join(f"Partial answer {i + 1}:\n{answer}" for i, answer in enumerate(answers))
+    return f"{prefix}\n\n{parts}\n\nUser query: {user_query}"
+
+# --- Result Sets ---
+# A result set describes the current table view without copying rows: the
+# source DataFrame, the row positions shown (in display order), the visible
+# columns, and a bool matrix flagging which cells matched the search.
+def make_result_set(df, positions, match=None, match_columns=None, columns=None):
+    if match is None:
+        match = np.zeros((len(positions), 0), dtype=bool)
+        match_columns = []
+    return {
+        'df': df,
+        'positions': np.asarray(positions, dtype=np.int64),
+        'columns': list(df.columns) if columns is None else list(columns),
+        'match': match,
+        'match_columns': list(df.columns) if match_columns is None else list(match_columns)
+    }
+
+def message_result_set(data):
+    """A one-row result set carrying a status or error message."""
+    return make_result_set(pd.DataFrame([data]), [0])
+
+def search_result_set(csv_path, search_text, mode='literal'):
+    df, positions, match = search_table(csv_path, search_text, mode)
+    return make_result_set(df, positions, match)
+
+def all_rows_result_set(csv_path):
+    """Result set viewing every row of the table, nothing highlighted."""
+    df = load_csv_cached(csv_path)
+    return make_result_set(df, np.arange(len(df)))
+
+def take_result_rows(result_set, rows):
+    """Result set restricted/reordered to rows (indices or a bool mask over its rows)."""
+    subset = dict(result_set)
+    subset['positions'] = result_set['positions'][rows]
+    subset['match'] = result_set['match'][rows]
+    return subset
+
+def result_frame(result_set, start=None, stop=None):
+    """Materializes rows start:stop of a result set as a DataFrame."""
+    positions = result_set['positions'][start:stop]
+    return result_set['df'].iloc[positions][result_set['columns']]
+
+def result_records(result_set, start=None, stop=None):
+    """Rows start:stop in the {'row_index', 'data', 'matching_columns'} format."""
+    frame = result_frame(result_set, start, stop)
+    frame = frame.astype(object).where(frame.notna(), '')
+    match = result_set['match'][start:stop]
+    visible = set(result_set['columns'])
+    match_columns = result_set['match_columns']
+    records = []
+    for i, (row_index, row) in enumerate(zip(frame.index, frame.to_dict('records'))):
+        records.append({
+            'row_index': int(row_index),
+            'data': row,
+            'matching_columns': [match_columns[j] for j in np.flatnonzero(match[i]) if match_columns[j] in visible]
+        })
+    return records
+
+def result_strings(result_set, column):
+    """Values of one column over the result rows as plain strings ('' when missing)."""
+    values = result_set['df'][column].iloc[result_set['positions']]
+    values = values.astype(object).where(values.notna(), '').astype(str)
+    return values.reset_index(drop=True)
+
+def parse_contains(condition):
+    """Splits 'column contains value' into (column, lower-cased value)."""
+    parts = condition.split()
+    contains_index = parts.index('contains')
+    return ' '.join(parts[:contains_index]), ' '.join(parts[contains_index + 1:]).lower()
+
+# --- Action Pipelines ---
+# Every session keeps an ordered pipeline: the search step followed by each
+# applied action, with the result set of every step cached. Appending an
+# action only computes the new step; undo pops a step without recomputing.
+table_pipelines = OrderedDict()
+MAX_PIPELINES = 32
+MAX_ROW_RANGE = 1000  # Most rows one /rows request returns
+
+def start_pipeline(csv_path, query, mode, result_set, job=None):
+    """Starts a new pipeline for the session; an empty query views all rows."""
+    pipeline_id = uuid.uuid4().hex
+    first_action = {'action': 'search', 'query': query, 'mode': mode} if query else {'action': 'restore'}
+    search_step = {'action': first_action, 'result': result_set}
+    if job is not None and 'future' in job:
+        # The rest of the table was searched in the background (and may still
+        # be); the full result is picked up from the search cache later
+        search_step['job'] = job
+    # 'version' changes whenever the result does; /rows clients use it to spot stale views
+    pipeline = {'id': pipeline_id, 'version': 0, 'csv_path': csv_path, 'query': query, 'mode': mode, 'steps': [search_step]}
+    with state_lock:
+        table_pipelines[pipeline_id] = pipeline
+        while len(table_pipelines) > MAX_PIPELINES:
+            table_pipelines.popitem(last=False)
+    session['pipeline_id'] = pipeline_id
+    return pipeline
+
+def current_pipeline(resolve=True):
+    """
+    The session's pipeline, rebuilt from the last search if it was evicted.
+    With resolve=False a "first page fast" search step is left pending.
+    """
+    pipeline_id = session.get('pipeline_id')
+    with state_lock:
+        pipeline = table_pipelines.get(pipeline_id)
+        if pipeline is not None:
+            table_pipelines.move_to_end(pipeline_id)
+    if pipeline is not None:
+        return resolve_pipeline_search(pipeline) if resolve else pipeline
+    query = session.get('last_query', '')
+    csv_path = session.get('csv_path', DEFAULT_CSV_PATH)
+    if not os.path.exists(csv_path):
+        return None
+    mode = session.get('search_mode', 'literal')
+    if query:
+        return start_pipeline(csv_path, query, mode, search_result_set(csv_path, query, mode))
+    if session.get('view_all'):
+        return start_pipeline(csv_path, '', mode, all_rows_result_set(csv_path))
+    return None
+
+def resolve_pipeline_search(pipeline):
+    """
+    Swaps a "first page fast" search step for the complete result. The first
+    page is a prefix of it, so rows already served stay valid and the
+    pipeline's version is left alone.
+    """
+    search_step = pipeline['steps'][0]
+    if not pipeline['query']:
+        return pipeline
+    job = search_step.pop('job', None)
+    if job is not None:
+        job['future'].result()
+        search_step['result'] = search_result_set(pipeline['csv_path'], pipeline['query'], pipeline['mode'])
+    return pipeline
+
+def pipeline_result(pipeline):
+    return pipeline['steps'][-1]['result']
+
+def pipeline_step_names(pipeline):
+    return [step['action'].get('action', '?') for step in pipeline['steps']]
+
+def append_pipeline_step(pipeline, action):
+    result_set = manipulate_results(pipeline_result(pipeline), action)
+    pipeline['steps'].append({'action': action, 'result': result_set})
+    pipeline['version'] += 1
+    return result_set
+
+def undo_pipeline_step(pipeline):
+    """Drops the last action (never the search step) and returns the new tail."""
+    if len(pipeline['steps']) > 1:
+        pipeline['steps'].pop()
+        pipeline['version'] += 1
+    return pipeline_result(pipeline)
+
 # --- Updated Manipulate Results Function ---
-def manipulate_results(search_results, action):
-    if not search_results:
-        return search_results
+def manipulate_results(result_set, action):
+    """
+    Applies one AI/table action to a result set with vectorized pandas/numpy
+    operations over the matched rows only, returning a new result set.
+    Actions keep the JSON contract the AI emits (sort, filter,
+    select_columns, deduplicate, group, count, combine, merge,
+    remove_no_match_columns).
+    """
+    if not len(result_set['positions']):
+        return result_set
+    columns = result_set['columns']
     try:
         if action['action'] == 'sort':
             column = action.get('column')
             order = action.get('order', 'ascending')
-            if column in search_results[0]['data']:
-                search_results.sort(
-                    key=lambda x: x['data'][column].lower() if isinstance(x['data'][column], str) else x['data'][column],
-                    reverse=(order.lower() == 'descending')
-                )
+            if column in columns:
+                keys = result_strings(result_set, column).str.lower()
+                ordered = keys.sort_values(ascending=(order.lower() != 'descending'), kind='stable')
+                result_set = take_result_rows(result_set, ordered.index.to_numpy())
         elif action['action'] == 'filter':
             conditions = action.get('conditions', [])
             relation = action.get('relation', 'AND')
-            if conditions:
-                filtered_results = []
-                for result in search_results:
-                    match = True
-                    for condition in conditions:
-                        column = condition.get('column')
-                        cond = condition.get('condition', '')
-                        if column in result['data']:
-                            if 'contains' in cond:
-                                value = cond.split('contains')[1].strip().lower()
-                                if value not in str(result['data'][column]).lower():
-                                    match = False
-                                    if relation == 'OR':
-                                        match = True
-                                        break
-                            elif 'is not empty' in cond:
-                                if not str(result['data'][column]).strip():
-                                    match = False
-                                    if relation == 'OR':
-                                        match = True
-                                        break
-                    if match:
-                        filtered_results.append(result)
-                search_results = filtered_results
+            masks = []
+            for condition in conditions:
+                column = condition.get('column')
+                cond = condition.get('condition', '')
+                if column not in columns:
+                    continue
+                values = result_strings(result_set, column)
+                if 'contains' in cond:
+                    value = cond.split('contains')[1].strip().lower()
+                    masks.append(values.str.lower().str.contains(value, regex=False).to_numpy(dtype=bool))
+                elif 'is not empty' in cond:
+                    masks.append((values.str.strip() != '').to_numpy(dtype=bool))
+            if masks:
+                combined = np.logical_or.reduce(masks) if relation == 'OR' else np.logical_and.reduce(masks)
+                result_set = take_result_rows(result_set, combined)
         elif action['action'] == 'select_columns':
-            columns = [col.strip('\"').strip() for col in action.get('columns', [])]
-            if columns:
-                # Validate requested columns exist in data
-                available_columns = list(search_results[0]['data'].keys()) if search_results else []
-            missing_columns = [col for col in columns if col not in available_columns]
-            
+            selected = [col.strip('\"').strip() for col in action.get('columns', [])]
+            missing_columns = [col for col in selected if col not in columns]
             if missing_columns:
-                return [{
-                    'row_index': 0,
-                    'data': {"Error": f"Columns not found: {', '.join(missing_columns)}"},
-                    'matching_columns': []
-                }]
-                
-            # Always update session with selected columns
-            session['columns'] = columns
-            
-            # Update search results with selected columns
-            filtered_results = []
-            for result in search_results:
-                new_data = {col: result['data'][col] for col in columns if col in result['data']}
-                if new_data:  # Only include results that have the requested columns
-                    result['data'] = new_data
-                    result['matching_columns'] = [col for col in result['matching_columns'] if col in columns]
-                    filtered_results.append(result)
-            
-            search_results = filtered_results
-            # Force reload of CSV in next search to ensure column selections persist
-            csv_cache.clear()
+                return message_result_set({"Error": f"Columns not found: {', '.join(missing_columns)}"})
+            if selected:
+                # Always update session with selected columns
+                session['columns'] = selected
+                result_set = dict(result_set, columns=selected)
         elif action['action'] == 'deduplicate':
             column = action.get('column')
-            if column in search_results[0]['data']:
-                seen = set()
-                deduplicated = []
-                for result in search_results:
-                    value = result['data'][column]
-                    if value not in seen:
-                        seen.add(value)
-                        deduplicated.append(result)
-                search_results = deduplicated
+            if column in columns:
+                keep = ~result_strings(result_set, column).duplicated().to_numpy()
+                result_set = take_result_rows(result_set, keep)
         elif action['action'] == 'group':
             column = action.get('column')
             aggregate = action.get('aggregate', 'count')
-            if column in search_results[0]['data']:
-                grouped = {}
-                for result in search_results:
-                    key = result['data'][column]
-                    grouped.setdefault(key, []).append(result)
-                new_results = []
-                for key, group in grouped.items():
-                    if aggregate == 'count':
-                        new_data = {column: key, 'count': len(group)}
-                        new_results.append({
-                            'row_index': group[0]['row_index'],
-                            'data': new_data,
-                            'matching_columns': []
-                        })
-                search_results = new_results
+            if column in columns and aggregate == 'count':
+                codes, uniques = pd.factorize(result_strings(result_set, column))
+                _, first = np.unique(codes, return_index=True)
+                row_index = result_set['df'].index[result_set['positions'][first]]
+                grouped = pd.DataFrame({column: np.asarray(uniques, dtype=object), 'count': np.bincount(codes)}, index=row_index)
+                result_set = make_result_set(grouped, np.arange(len(grouped)))
         elif action['action'] == 'count':
             condition = action.get('condition', '')
-            parts = condition.split()
-            if 'contains' in parts:
-                contains_index = parts.index('contains')
-                column = ' '.join(parts[:contains_index])
-                value = ' '.join(parts[contains_index + 1:]).lower()
-                if column in search_results[0]['data']:
-                    count = sum(1 for result in search_results if value in str(result['data'].get(column, '')).lower())
-                    search_results = [{
-                        'row_index': 0,
-                        'data': {'Result': f"Count of rows where {column} contains {value}", 'Count': count},
-                        'matching_columns': []
-                    }]
+            if 'contains' in condition.split():
+                column, value = parse_contains(condition)
+                if column in columns:
+                    count = int(result_strings(result_set, column).str.lower().str.contains(value, regex=False).sum())
+                    result_set = message_result_set({'Result': f"Count of rows where {column} contains {value}", 'Count': count})
                 else:
-                    search_results = [{
-                        'row_index': 0,
-                        'data': {'Result': f"Column '{column}' not found", 'Count': 0},
-                        'matching_columns': []
-                    }]
+                    result_set = message_result_set({'Result': f"Column '{column}' not found", 'Count': 0})
             elif 'is not empty' in condition:
                 column = condition.replace(' is not empty', '').strip()
-                if column in search_results[0]['data']:
-                    count = sum(1 for result in search_results if result['data'].get(column, '') != '')
-                    search_results = [{
-                        'row_index': 0,
-                        'data': {'Result': f"Count of rows where {column} is not empty", 'Count': count},
-                        'matching_columns': []
-                    }]
+                if column in columns:
+                    count = int((result_strings(result_set, column) != '').sum())
+                    result_set = message_result_set({'Result': f"Count of rows where {column} is not empty", 'Count': count})
                 else:
-                    search_results = [{
-                        'row_index': 0,
-                        'data': {'Result': f"Column '{column}' not found", 'Count': 0},
-                        'matching_columns': []
-                    }]
+                    result_set = message_result_set({'Result': f"Column '{column}' not found", 'Count': 0})
             else:
-                search_results = [{
-                    'row_index': 0,
-                    'data': {'Result': "Invalid condition format", 'Count': 0},
-                    'matching_columns': []
-                }]
+                result_set = message_result_set({'Result': "Invalid condition format", 'Count': 0})
         elif action['action'] == 'combine':
             # Validate column names before combining
             column = action.get('column')
             condition = action.get('condition', '')
             new_column = action.get('new_column')
-            
+
             if not column or not new_column:
-                return [{
-                    'row_index': 0,
-                    'data': {'Error': 'Both column and new_column must be specified for combine action'},
-                    'matching_columns': []
-                }]
-                
-            if column not in search_results[0]['data']:
-                return [{
-                    'row_index': 0,
-                    'data': {'Error': f"Column '{column}' not found in data"},
-                    'matching_columns': []
-                }]
-                
+                return message_result_set({'Error': 'Both column and new_column must be specified for combine action'})
+            if column not in columns:
+                return message_result_set({'Error': f"Column '{column}' not found in data"})
             if 'contains' not in condition:
-                return [{
-                    'row_index': 0,
-                    'data': {'Error': 'Combine action requires a "contains" condition'},
-                    'matching_columns': []
-                }]
-                
-            parts = condition.split()
-            contains_index = parts.index('contains')
-            value = ' '.join(parts[contains_index + 1:]).lower()
-            
+                return message_result_set({'Error': 'Combine action requires a "contains" condition'})
+
+            _, value = parse_contains(condition)
+
             # Store combined column in session for later cleanup
             if 'combined_columns' not in session:
                 session['combined_columns'] = []
             session['combined_columns'].append(new_column)
-            
-            # Update the in-memory DataFrame cache
-            csv_path = session.get('csv_path')
-            if csv_path:
-                df = load_csv_cached(csv_path)
-                for idx, result in enumerate(search_results):
-                    if value in str(result['data'][column]).lower():
-                        df.at[result['row_index'], new_column] = result['data'][column]
-                    else:
-                        df.at[result['row_index'], new_column] = ""
-                # Save the modified DataFrame back to CSV
-                df.to_csv(csv_path, index=False)
-                # Clear cache to force reload
-                csv_cache.clear()
-                # Update session with new columns
-                if 'columns' in session:
-                    session['columns'] = list(df.columns)
-            
-            for result in search_results:
-                if value in str(result['data'][column]).lower():
-                    result['data'][new_column] = result['data'][column]
-                else:
-                    result['data'][new_column] = ""
-                
-                if new_column not in result['matching_columns']:
-                    result['matching_columns'].append(new_column)
+
+            values = result_strings(result_set, column)
+            combined = values.where(values.str.lower().str.contains(value, regex=False), '')
+            result_set = add_result_column(result_set, new_column, combined.to_numpy(dtype=object), highlight=True)
         elif action['action'] == 'merge':
             columns_to_merge = action.get('columns', [])
             new_column = action.get('new_column')
-            valid_columns = [col for col in columns_to_merge if col in search_results[0]['data']]
-            if valid_columns:
-                # Update the in-memory DataFrame cache
-                csv_path = session.get('csv_path')
-                if csv_path:
-                    df = load_csv_cached(csv_path)
-                    for idx, result in enumerate(search_results):
-                        merged_value = ', '.join([str(result['data'].get(col, '')) for col in valid_columns if result['data'].get(col, '')])
-                        df.at[result['row_index'], new_column] = merged_value
-                    # Save the modified DataFrame back to CSV
-                    df.to_csv(csv_path, index=False)
-                    # Clear cache to force reload
-                    csv_cache.clear()
-                    # Update session with new columns
-                    if 'columns' in session:
-                        session['columns'] = list(df.columns)
-                
-                # Update search results
-                for result in search_results:
-                    merged_value = ', '.join([str(result['data'].get(col, '')) for col in valid_columns if result['data'].get(col, '')])
-                    result['data'][new_column] = merged_value
+            valid_columns = [col for col in columns_to_merge if col in columns]
+            if valid_columns and new_column:
+                merged = None
+                for col in valid_columns:
+                    values = result_strings(result_set, col)
+                    if merged is None:
+                        merged = values
+                    else:
+                        separator = pd.Series(np.where((merged != '') & (values != ''), ', ', ''))
+                        merged = merged + separator + values
+                result_set = add_result_column(result_set, new_column, merged.to_numpy(dtype=object))
         elif action['action'] == 'remove_no_match_columns':
             # Remove all columns that didn't match the search query
-            removed_columns = set()
-            for result in search_results:
-                # Get all columns that didn't match
-                no_match_cols = [col for col in result['data'] if col not in result['matching_columns']]
-                # Track removed columns
-                removed_columns.update(no_match_cols)
-                # Remove them from the data
-                for col in no_match_cols:
-                    if col in result['data']:
-                        del result['data'][col]
-                # Also remove from matching_columns if present
-                result['matching_columns'] = [col for col in result['matching_columns'] if col not in no_match_cols]
-            
-            # Generate clean response message
+            match_columns = result_set['match_columns']
+            matched = {match_columns[j] for j in np.flatnonzero(result_set['match'].any(axis=0))}
+            kept = [col for col in columns if col in matched]
+            removed_columns = [col for col in columns if col not in matched]
             if removed_columns:
-                return [{
-                    'row_index': 0,
-                    'data': {
-                        'Result': 'Removed columns not matching search',
-                        'Columns': ', '.join(sorted(removed_columns))
-                    },
-                    'matching_columns': []
-                }] + search_results
+                message = {'Result': 'Removed columns not matching search', 'Columns': ', '.join(sorted(removed_columns))}
             else:
-                return [{
-                    'row_index': 0,
-                    'data': {
-                        'Result': 'No columns removed - all columns match search'
-                    },
-                    'matching_columns': []
-                }] + search_results
-        return search_results
+                message = {'Result': 'No columns removed - all columns match search'}
+            # Generate clean response message ahead of the remaining rows
+            frame = pd.concat([pd.DataFrame([message]), result_frame(result_set)[kept]])
+            match = np.vstack([
+                np.zeros((1, len(kept)), dtype=bool),
+                result_set['match'][:, [match_columns.index(col) for col in kept]]
+            ])
+            return make_result_set(frame, np.arange(len(frame)), match, kept)
+        return result_set
     except Exception as e:
         print(f"Error in manipulate_results: {e}")
-        return search_results
+        return result_set
+
+def add_result_column(result_set, new_column, values, highlight=False):
+    """
+    Adds a derived column to the result rows on a shallow copy of the result
+    set's table (rows outside the result keep their value, or '' when new),
+    so the cached table and other pipelines never see it. result_set
+    ['derived'] records the column with a fresh token and the lineage of the
+    cached table it extends; it is saved to the CSV only via /persist_columns.
+    """
+    df = result_set['df']
+    derived = result_set.get('derived') or {'lineage': table_lineage(df), 'rows': len(df), 'columns': {}}
+    if new_column in df.columns:
+        full = df[new_column].astype(object).where(df[new_column].notna(), '').to_numpy()
+    else:
+        full = np.full(len(df), '', dtype=object)
+    full[result_set['positions']] = values
+    df = df.copy(deep=False)
+    df[new_column] = full
+    columns = {column: token for column, token in derived['columns'].items() if column != new_column}
+    columns[new_column] = uuid.uuid4().hex
+    # Update session with new columns
+    if 'columns' in session:
+        session['columns'] = list(df.columns)
+    result_set = dict(result_set, df=df, derived=dict(derived, columns=columns))
+    if new_column not in result_set['columns']:
+        result_set['columns'] = result_set['columns'] + [new_column]
+    if highlight and new_column not in result_set['match_columns']:
+        result_set['match_columns'] = result_set['match_columns'] + [new_column]
+        result_set['match'] = np.hstack([result_set['match'], np.ones((len(result_set['positions']), 1), dtype=bool)])
+    return result_set
 
 # --- Helper to Get CSV Columns ---
+def read_csv_sample(stream, size):
+    """
+    Header, first rows and an estimated row count of the CSV in stream (size
+    bytes), from its first HEADER_SAMPLE_BYTES only (more if the header and
+    first row alone are longer). Column names are made unique the way
+    pandas does ('Unnamed: 3', 'name.1'). The estimate is exact when the
+    whole file fit in the sample, otherwise extrapolated from the average
+    size of the sampled rows.
+    """
+    data = stream.read(HEADER_SAMPLE_BYTES)
+    while data.count(b'\n') < 2:
+        more = stream.read(HEADER_SAMPLE_BYTES)
+        if not more:
+            break
+        data += more
+    truncated = len(data) < size
+    if truncated:
+        data = data[:data.rfind(b'\n') + 1]
+    rows = [row for row in csv.reader(io.StringIO(data.decode('utf-8-sig', errors='replace'))) if row]
+    if not rows:
+        return {'columns': [], 'sample_rows': [], 'estimated_rows': 0}
+    # As pandas' C parser: named columns keep their names before unnamed ones,
+    # and a renamed duplicate skips names already in the header
+    columns = [name or f"Unnamed: {i}" for i, name in enumerate(rows[0])]
+    order = [i for i, name in enumerate(rows[0]) if name] + [i for i, name in enumerate(rows[0]) if not name]
+    seen = {}
+    for i in order:
+        name = columns[i]
+        base = name
+        count = seen.get(name, 0)
+        while count:
+            seen[base] = count + 1
+            name = f"{base}.{count}"
+            count = count + 1 if name in columns else seen.get(name, 0)
+        columns[i] = name
+        seen[name] = count + 1
+    header_bytes = data.find(b'\n') + 1
+    body_rows = len(rows) - 1
+    if truncated and body_rows and len(data) > header_bytes:
+        estimated = round(body_rows * (size - header_bytes) / (len(data) - header_bytes))
+    else:
+        estimated = body_rows
+    return {
+        'columns': columns,
+        'sample_rows': [dict(zip(columns, row)) for row in rows[1:HEADER_SAMPLE_ROWS + 1]],
+        'estimated_rows': estimated
+    }
+
+def get_csv_sample(csv_path):
+    """read_csv_sample for a file on disk, cached per (csv_path, mtime)."""
+    key = (csv_path, os.path.getmtime(csv_path))
+    with csv_sample_lock:
+        sample = csv_samples.get(key)
+        if sample is not None:
+            csv_samples.move_to_end(key)
+            return sample
+    with open(csv_path, 'rb') as f:
+        sample = read_csv_sample(f, os.fstat(f.fileno()).st_size)
+    with csv_sample_lock:
+        csv_samples[key] = sample
+        while len(csv_samples) > CSV_SAMPLE_CACHE_SIZE:
+            csv_samples.popitem(last=False)
+    return sample
+
 def get_csv_columns(csv_path):
     try:
-        df = pd.read_csv(csv_path, nrows=1)
-        return list(df.columns)
+        return list(get_csv_sample(csv_path)['columns'])
     except Exception as e:
         print(f"Error reading CSV columns: {e}")
         return []
@@ -599,9 +2460,18 @@ def preview_csv_headers():
     if not file.filename.endswith('.csv'):
         return jsonify({"error": "Please upload a CSV file."})
     try:
-        df = pd.read_csv(file, nrows=1)
-        headers = list(df.columns)
-        return jsonify({"headers": headers})
+        stream = file.stream
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        sample = read_csv_sample(stream, size)
+        if not sample['columns']:
+            return jsonify({"error": "The CSV file has no header row."})
+        return jsonify({
+            "headers": sample['columns'],
+            "sample_rows": sample['sample_rows'],
+            "estimated_rows": sample['estimated_rows']
+        })
     except Exception as e:
         return jsonify({"error": f"Error reading CSV headers: {str(e)}"})
 
@@ -628,6 +2498,8 @@ HTML_TEMPLATE = """
         th { background: #f5f5f7; font-weight: bold; position: sticky; top: 0; z-index: 1; cursor: pointer; }
         body.dark-mode th { background: #3b4a5a; }
         .highlight { background: #ffeb3b; }
+        .virtual-table td { white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
+        .virtual-table tr.virtual-spacer td { padding: 0; border: none; }
         .modal { display: none; position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0,0,0,0.5); z-index: 1000; }
         .modal-content { background: white; margin: 10% auto; padding: 30px; width: 450px; border-radius: 8px; transition: background 0.3s; }
         body.dark-mode .modal-content { background: #2c3e50; }
@@ -668,6 +2540,7 @@ HTML_TEMPLATE = """
         body.dark-mode .chat-entry:hover { background: #3b4a5a; }
         .chat-entry summary { cursor: pointer; font-weight: bold; margin-bottom: 5px; display: flex; justify-content: space-between; align-items: center; }
         .chat-entry p { margin: 5px 0; max-height: 100px; overflow-y: auto; }
+        .chat-pager { justify-content: space-between; align-items: center; gap: 10px; margin-top: 10px; }
         .chat-timestamp { font-size: 12px; color: #666; margin-bottom: 5px; }
         body.dark-mode .chat-timestamp { color: #b0b0b0; }
         .delete-chat { background: #d32f2f; padding: 4px 8px; font-size: 12px; }
@@ -712,6 +2585,7 @@ HTML_TEMPLATE = """
                     <p>{{ current_csv_path }}</p>
                     <label>Upload New CSV File:</label>
                     <input type="file" name="csv_file" id="csvFileInput" accept=".csv">
+                    <div class="model-description" id="csvPreview"></div>
                     <!-- Removed Search Column field per request -->
                     <label>Rows Per Page:</label>
                     <input type="number" name="rows_per_page" id="rowsPerPageInput" value="{{ current_rows_per_page }}" min="1" max="100">
@@ -723,6 +2597,7 @@ HTML_TEMPLATE = """
                         <option value="gemini-2.0-flash-thinking-exp-01-21" {% if current_model == 'gemini-2.0-flash-thinking-exp-01-21' %}selected{% endif %}>Gemini 2.0 Flash Thinking</option>
                     </select>
                     <div class="model-description" id="modelDescription"></div>
+                    <label><input type="checkbox" name="compact_strings" value="true" {% if compact_strings %}checked{% endif %}> Compact memory mode (Arrow strings + categorical columns)</label>
                     <label>API Key:</label>
                     <input type="text" name="api_key" value="{{ current_api_key }}" placeholder="Enter your API key here">
                     <!-- Hidden input for dark mode state -->
@@ -739,7 +2614,7 @@ HTML_TEMPLATE = """
         <div class="sidebar" id="chatSidebar">
             <h3>Chat History</h3>
             <div class="chat-search">
-                <input type="text" id="chatSearchInput" placeholder="Search chat history..." onkeyup="filterChatHistory()">
+                <input type="text" id="chatSearchInput" placeholder="Search chat history..." oninput="filterChatHistory()">
             </div>
             <button class="clear-history" id="clearHistoryBtn">Clear History</button>
             <div id="chatHistory">
@@ -754,29 +2629,61 @@ HTML_TEMPLATE = """
                     </details>
                 {% endfor %}
             </div>
+            <div class="chat-pager" id="chatPager" style="display: {{ 'flex' if chat_total_pages > 1 else 'none' }};">
+                <button id="chatPrevBtn" onclick="loadChatHistory(chatPage - 1)">Newer</button>
+                <span id="chatPageInfo">1 / {{ chat_total_pages }}</span>
+                <button id="chatNextBtn" onclick="loadChatHistory(chatPage + 1)">Older</button>
+            </div>
         </div>
         <!-- Search Form -->
         <!-- Updated label to reflect searching across all columns -->
         <form id="searchForm">
-            <label>Search in all columns:</label><br>
+            <label>Search in all columns (or narrow it: email:gmail.com, state:TX AND city:austin, "quoted phrase"):</label><br>
             <input type="text" id="searchQuery" required>
-            <input type="submit" value="Search">
+            <div class="options">
+                <label>Match:</label>
+                <select id="searchMode">
+                    <option value="literal">Contains (literal)</option>
+                    <option value="exact">Exact value</option>
+                    <option value="prefix">Starts with</option>
+                    <option value="regex">Regular expression</option>
+                </select>
+                <input type="submit" value="Search">
+            </div>
         </form>
         <!-- AI Query Section -->
         <div id="aiQuerySection" style="display:none; margin-top: 20px;">
             <form id="aiForm">
                 <label>Ask AI:</label><br>
                 <input type="text" id="aiQuery" required>
+                <label class="model-description"><input type="checkbox" id="aiBatch"> Ask about every result row (slower)</label>
                 <input type="submit" value="Ask AI">
             </form>
         </div>
         <!-- New Search and Export Buttons -->
         <div style="display: flex; gap: 10px; margin-top: 10px;">
             <button id="newSearchBtn" style="display:none;">New Search</button>
-            <button id="exportBtn" style="display:none;">Export as CSV</button>
+            <button id="restoreBtn">Show All Rows</button>
+            <button id="exportBtn" style="display:none;">Export</button>
+            <select id="exportFormat" style="display:none; width: auto;">
+                <option value="csv">CSV</option>
+                <option value="parquet">Parquet</option>
+                <option value="jsonl">JSON Lines</option>
+                <option value="xlsx">Excel (XLSX)</option>
+            </select>
+            <button id="undoBtn" style="display:none;">Undo Last Action</button>
+            <button id="persistBtn" style="display:none;">Save New Columns to CSV</button>
         </div>
+        <div class="model-description" id="pipelineSteps"></div>
         <!-- Display Options -->
         <div class="options" id="displayOptions" style="display:none;">
+            <div>
+                <label>Table View:</label>
+                <select id="tableView" onchange="changeTableView()">
+                    <option value="pages">Pages</option>
+                    <option value="scroll">Scroll</option>
+                </select>
+            </div>
             <div>
                 <label>Table Text Wrap:</label>
                 <select id="tableWrap" onchange="updateDisplayOptions()">
@@ -837,6 +2744,7 @@ HTML_TEMPLATE = """
             });
 
             document.getElementById('darkModeBtn').addEventListener('click', toggleDarkMode);
+            document.getElementById('searchResults').addEventListener('scroll', scheduleVirtualRender);
             document.getElementById('chatHistoryBtn').addEventListener('click', toggleChatHistory);
             document.getElementById('clearHistoryBtn').addEventListener('click', clearChatHistory);
 
@@ -858,6 +2766,18 @@ HTML_TEMPLATE = """
                 exportCSV();
             });
 
+            document.getElementById('undoBtn').addEventListener('click', () => {
+                undoAction();
+            });
+
+            document.getElementById('restoreBtn').addEventListener('click', () => {
+                restoreOriginal();
+            });
+
+            document.getElementById('persistBtn').addEventListener('click', () => {
+                persistColumns();
+            });
+
             document.getElementById('settingsForm').addEventListener('submit', () => {
                 document.getElementById('darkModeInput').value = isDarkMode;
             });
@@ -879,106 +2799,253 @@ HTML_TEMPLATE = """
                     showError(data.error);
                     return;
                 }
+                document.getElementById('csvPreview').textContent =
+                    `${data.headers.length} columns, about ${data.estimated_rows.toLocaleString()} rows: ${data.headers.join(', ')}`;
+            } catch (err) {
+                console.error('Error previewing CSV headers:', err);
+                showError('Failed to preview CSV headers: ' + err.message);
+            }
+        }
+
+        function updateModelDescription() {
+            const model = document.getElementById('modelSelect').value;
+            document.getElementById('modelDescription').textContent = modelDescriptions[model] || '';
+        }
+
+        async function doSearch() {
+            const query = document.getElementById('searchQuery').value.trim();
+            const mode = document.getElementById('searchMode').value;
+            if (!query) {
+                showError('Please enter a search query.');
+                return;
+            }
+            showLoading(true);
+            try {
+                currentPage = 1;
+                const response = await fetch('/search', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({query: query, mode: mode, page: currentPage, fast: true, format: TABLE_FORMAT})
+                });
+                if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                const data = await response.json();
+                showLoading(false);
+                if (data.error) {
+                    showError(data.error);
+                    return;
+                }
+                showTable(data);
+                totalPages = data.total_pages;
+                updatePagination();
+                updatePipelineSteps(data.steps);
+                updateUnsavedColumns(data.unsaved_columns);
+                if (data.total_pending) {
+                    pollSearchTotal(data.job_id);
+                }
+                document.getElementById('aiQuerySection').style.display = 'block';
+                document.getElementById('newSearchBtn').style.display = 'block';
+                document.getElementById('exportBtn').style.display = 'block';
+                document.getElementById('exportFormat').style.display = 'block';
+                document.getElementById('displayOptions').style.display = 'block';
+                document.getElementById('pagination').style.display = totalPages > 1 && !isScrollView() ? 'flex' : 'none';
+                document.getElementById('aiResponse').innerHTML = '';
+                updateDisplayOptions();
+                sessionStorage.setItem('currentQuery', query);
+                sessionStorage.setItem('currentMode', mode);
             } catch (err) {
-                console.error('Error previewing CSV headers:', err);
-                showError('Failed to preview CSV headers: ' + err.message);
+                handleError(err);
             }
         }
 
-        function updateModelDescription() {
-            const model = document.getElementById('modelSelect').value;
-            document.getElementById('modelDescription').textContent = modelDescriptions[model] || '';
-        }
-
-        async function doSearch() {
-            const query = document.getElementById('searchQuery').value.trim();
-            if (!query) {
-                showError('Please enter a search query.');
-                return;
-            }
+        async function restoreOriginal() {
             showLoading(true);
             try {
                 currentPage = 1;
-                const response = await fetch('/search', {
+                const response = await fetch('/restore', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({query: query, page: currentPage})
+                    body: JSON.stringify({page: currentPage, format: TABLE_FORMAT})
                 });
-                if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
                 const data = await response.json();
                 showLoading(false);
                 if (data.error) {
                     showError(data.error);
                     return;
                 }
-                document.getElementById('searchResults').innerHTML = data.html;
+                showTable(data);
                 totalPages = data.total_pages;
                 updatePagination();
+                updatePipelineSteps(data.steps);
+                updateUnsavedColumns(data.unsaved_columns);
                 document.getElementById('aiQuerySection').style.display = 'block';
                 document.getElementById('newSearchBtn').style.display = 'block';
                 document.getElementById('exportBtn').style.display = 'block';
+                document.getElementById('exportFormat').style.display = 'block';
                 document.getElementById('displayOptions').style.display = 'block';
-                document.getElementById('pagination').style.display = totalPages > 1 ? 'flex' : 'none';
-                document.getElementById('aiResponse').innerHTML = '';
+                document.getElementById('pagination').style.display = totalPages > 1 && !isScrollView() ? 'flex' : 'none';
                 updateDisplayOptions();
-                sessionStorage.setItem('currentQuery', query);
+                // Pagination goes through the server-side view, not a query
+                sessionStorage.setItem('currentQuery', '');
             } catch (err) {
                 handleError(err);
             }
         }
 
+        async function pollSearchTotal(jobId) {
+            // Page 1 is shown already; refresh the page count once counting is done
+            const status = document.createElement('div');
+            status.id = 'searchTotalStatus';
+            status.className = 'model-description';
+            status.textContent = `About ${totalPages} pages (still counting...)`;
+            document.getElementById('pagination').after(status);
+            try {
+                while (true) {
+                    await new Promise(resolve => setTimeout(resolve, 500));
+                    const response = await fetch(`/search_status?job=${jobId}`);
+                    if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                    const data = await response.json();
+                    if (data.status === 'error') throw new Error(data.error);
+                    if (sessionStorage.getItem('currentQuery') === null) return;
+                    totalPages = data.total_pages;
+                    if (data.status === 'done') break;
+                    status.textContent = `About ${totalPages} pages (still counting...)`;
+                }
+                updatePagination();
+                document.getElementById('pagination').style.display = totalPages > 1 && !isScrollView() ? 'flex' : 'none';
+            } catch (err) {
+                console.error('Error fetching search total:', err);
+            } finally {
+                status.remove();
+            }
+        }
+
         async function doAIQuery() {
             const userQuery = document.getElementById('aiQuery').value.trim();
             if (!userQuery) {
                 showError('Please enter an AI query.');
                 return;
             }
-            showLoading(true);
             try {
                 const response = await fetch('/ai_query', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({userQuery: userQuery})
+                    body: JSON.stringify({userQuery: userQuery, batch: document.getElementById('aiBatch').checked})
                 });
                 if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
                 const data = await response.json();
-                showLoading(false);
-                const aiResponseDiv = document.getElementById('aiResponse');
-                const newResponse = document.createElement('div');
-                newResponse.innerHTML = data.ai_html;
-                aiResponseDiv.appendChild(newResponse);
-                aiResponseDiv.scrollTop = aiResponseDiv.scrollHeight;
-                if (data.chat_html) {
-                    document.getElementById('chatHistory').innerHTML = data.chat_html;
-                    filterChatHistory();
+                if (data.error) {
+                    showError(data.error);
+                    return;
+                }
+                if (data.job_id) {
+                    streamAIJob(data.job_id);
+                } else {
+                    await showAIResult(data);
                 }
-                const actionScript = newResponse.querySelector('script[type="ai-action"]');
-                if (actionScript) {
-                    const scriptContent = actionScript.textContent.trim();
+            } catch (err) {
+                handleError(err);
+            }
+        }
+
+        function streamAIJob(jobId) {
+            // The answer streams in while the table stays usable
+            const aiResponseDiv = document.getElementById('aiResponse');
+            const pending = document.createElement('div');
+            pending.className = 'ai-message';
+            const text = document.createElement('div');
+            text.style.whiteSpace = 'pre-wrap';
+            text.textContent = 'Thinking...';
+            const cancelBtn = document.createElement('button');
+            cancelBtn.textContent = 'Cancel';
+            pending.append(text, cancelBtn);
+            aiResponseDiv.appendChild(pending);
+            const attach = () => {
+                // The stream replays the chunks so far, so each attempt starts over
+                let received = '';
+                const source = new EventSource(`/ai_stream?job=${jobId}`);
+                const finish = async () => {
+                    source.close();
                     try {
-                        const action = JSON.parse(scriptContent);
-                        if (action) {
-                            const response = await fetch('/manipulate_table', {
-                                method: 'POST',
-                                headers: {'Content-Type': 'application/json'},
-                                body: JSON.stringify({action: action, page: currentPage})
-                            });
-                            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-                            const data = await response.json();
-                            if (data.html) {
-                                document.getElementById('searchResults').innerHTML = data.html;
-                                totalPages = data.total_pages;
-                                updatePagination();
-                                updateDisplayOptions();
-                            }
+                        const response = await fetch('/ai_result', {
+                            method: 'POST',
+                            headers: {'Content-Type': 'application/json'},
+                            body: JSON.stringify({job: jobId})
+                        });
+                        if (response.status === 409) {
+                            // Still running: the connection dropped, not the job
+                            setTimeout(attach, 1000);
+                            return;
+                        }
+                        if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                        pending.remove();
+                        await showAIResult(await response.json());
+                    } catch (err) {
+                        pending.remove();
+                        handleError(err);
+                    }
+                };
+                source.addEventListener('progress', event => {
+                    const progress = JSON.parse(event.data);
+                    if (progress) text.textContent = `Working through the results (${progress.stage}): ${progress.done}${progress.total == null ? '' : ` of ${progress.total}`} chunks done...`;
+                });
+                source.addEventListener('chunk', event => {
+                    received += JSON.parse(event.data);
+                    text.textContent = received;
+                    aiResponseDiv.scrollTop = aiResponseDiv.scrollHeight;
+                });
+                source.addEventListener('done', finish);
+                // Fired both for the job's 'error' event and for a dropped connection
+                source.addEventListener('error', finish);
+            };
+            attach();
+            cancelBtn.addEventListener('click', async () => {
+                cancelBtn.disabled = true;
+                await fetch('/ai_cancel', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({job: jobId})
+                });
+            });
+        }
+
+        async function showAIResult(data) {
+            const aiResponseDiv = document.getElementById('aiResponse');
+            const newResponse = document.createElement('div');
+            newResponse.innerHTML = data.ai_html;
+            aiResponseDiv.appendChild(newResponse);
+            aiResponseDiv.scrollTop = aiResponseDiv.scrollHeight;
+            if (data.chat_html) {
+                document.getElementById('chatSearchInput').value = '';
+                updateChatHistory({html: data.chat_html, page: 1, total_pages: data.chat_total_pages});
+            }
+            const actionScript = newResponse.querySelector('script[type="ai-action"]');
+            if (actionScript) {
+                const scriptContent = actionScript.textContent.trim();
+                try {
+                    const action = JSON.parse(scriptContent);
+                    if (action) {
+                        const response = await fetch('/manipulate_table', {
+                            method: 'POST',
+                            headers: {'Content-Type': 'application/json'},
+                            body: JSON.stringify({action: action, page: currentPage, format: TABLE_FORMAT})
+                        });
+                        if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                        const data = await response.json();
+                        if (data.error) {
+                            showError(data.error);
+                        } else if (data.table || data.html) {
+                            showTable(data);
+                            totalPages = data.total_pages;
+                            updatePagination();
+                            updateDisplayOptions();
+                            updatePipelineSteps(data.steps);
+                            updateUnsavedColumns(data.unsaved_columns);
                         }
-                    } catch (e) {
-                        console.error('Error parsing AI action:', e);
-                        showError('Failed to process AI action: ' + e.message);
                     }
+                } catch (e) {
+                    console.error('Error parsing AI action:', e);
+                    showError('Failed to process AI action: ' + e.message);
                 }
-            } catch (err) {
-                handleError(err);
             }
         }
 
@@ -989,31 +3056,94 @@ HTML_TEMPLATE = """
                 const response = await fetch('/manipulate_table', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({action: action, page: currentPage})
+                    body: JSON.stringify({action: action, page: currentPage, format: TABLE_FORMAT})
+                });
+                if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                const data = await response.json();
+                showLoading(false);
+                showTable(data);
+                totalPages = data.total_pages;
+                updatePagination();
+                updateDisplayOptions();
+                updatePipelineSteps(data.steps);
+                updateUnsavedColumns(data.unsaved_columns);
+            } catch (err) {
+                handleError(err);
+            }
+        }
+
+        async function undoAction() {
+            showLoading(true);
+            try {
+                const response = await fetch('/undo_action', {
+                    method: 'POST',
+                    headers: {'Content-Type': 'application/json'},
+                    body: JSON.stringify({page: 1, format: TABLE_FORMAT})
                 });
                 if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
                 const data = await response.json();
                 showLoading(false);
-                document.getElementById('searchResults').innerHTML = data.html;
+                currentPage = 1;
+                showTable(data);
                 totalPages = data.total_pages;
                 updatePagination();
                 updateDisplayOptions();
+                updatePipelineSteps(data.steps);
+                updateUnsavedColumns(data.unsaved_columns);
             } catch (err) {
                 handleError(err);
             }
         }
 
+        function updateUnsavedColumns(columns) {
+            const persistBtn = document.getElementById('persistBtn');
+            persistBtn.style.display = columns && columns.length ? 'block' : 'none';
+            persistBtn.title = columns && columns.length ? 'Unsaved: ' + columns.join(', ') : '';
+        }
+
+        async function persistColumns() {
+            try {
+                const response = await fetch('/persist_columns', { method: 'POST' });
+                const data = await response.json();
+                if (data.error) {
+                    showError(data.error);
+                    return;
+                }
+                while (true) {
+                    const statusResponse = await fetch('/persist_columns');
+                    const status = await statusResponse.json();
+                    if (status.status === 'error') throw new Error(status.error);
+                    if (status.status !== 'running') {
+                        updateUnsavedColumns(status.unsaved_columns);
+                        break;
+                    }
+                    await new Promise(resolve => setTimeout(resolve, 1000));
+                }
+                showSuccess('New columns saved to the CSV file.');
+            } catch (err) {
+                console.error('Error saving columns:', err);
+                showError('Failed to save columns: ' + err.message);
+            }
+        }
+
+        function updatePipelineSteps(steps) {
+            // Shows the applied steps, e.g. "search → filter → sort"
+            const stepsDiv = document.getElementById('pipelineSteps');
+            steps = steps || [];
+            stepsDiv.textContent = steps.length ? 'Steps: ' + steps.join(' → ') : '';
+            document.getElementById('undoBtn').style.display = steps.length > 1 ? 'block' : 'none';
+        }
+
         async function changePage(page) {
             if (page < 1 || page > totalPages) return;
             currentPage = page;
             showLoading(true);
             try {
-                const query = sessionStorage.getItem('currentQuery');
-                if (!query) throw new Error('No search query found for pagination.');
-                const response = await fetch('/search', {
+                if (sessionStorage.getItem('currentQuery') === null) throw new Error('No search query found for pagination.');
+                const response = await fetch('/view_page', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({query: query, page: currentPage})
+                    body: JSON.stringify({page: currentPage, format: TABLE_FORMAT})
                 });
                 if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
                 const data = await response.json();
@@ -1022,7 +3152,7 @@ HTML_TEMPLATE = """
                     showError(data.error);
                     return;
                 }
-                document.getElementById('searchResults').innerHTML = data.html;
+                showTable(data);
                 updatePagination();
                 updateDisplayOptions();
             } catch (err) {
@@ -1033,6 +3163,7 @@ HTML_TEMPLATE = """
         function updatePagination() {
             const pagination = document.getElementById('pagination');
             pagination.innerHTML = '';
+            if (isScrollView()) return;
             const prevButton = document.createElement('button');
             prevButton.textContent = 'Previous';
             prevButton.disabled = currentPage === 1;
@@ -1055,7 +3186,8 @@ HTML_TEMPLATE = """
         }
 
         function exportCSV() {
-            window.location.href = '/export';
+            const format = document.getElementById('exportFormat').value;
+            window.location.href = `/export?format=${format}&gzip=1`;
         }
 
         async function newSearch() {
@@ -1064,10 +3196,14 @@ HTML_TEMPLATE = """
             document.getElementById('aiQuerySection').style.display = 'none';
             document.getElementById('newSearchBtn').style.display = 'none';
             document.getElementById('exportBtn').style.display = 'none';
+            document.getElementById('exportFormat').style.display = 'none';
+            updatePipelineSteps([]);
+            updateUnsavedColumns([]);
             document.getElementById('displayOptions').style.display = 'none';
             document.getElementById('pagination').style.display = 'none';
             document.getElementById('searchQuery').value = '';
             sessionStorage.removeItem('currentQuery');
+            sessionStorage.removeItem('currentMode');
             try {
                 const response = await fetch('/reset');
                 if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
@@ -1082,8 +3218,8 @@ HTML_TEMPLATE = """
                 const response = await fetch('/clear_chat_history');
                 if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
                 const data = await response.json();
-                document.getElementById('chatHistory').innerHTML = data.html;
                 document.getElementById('chatSearchInput').value = '';
+                updateChatHistory(data);
             } catch (err) {
                 console.error('Error clearing chat history:', err);
                 showError('Failed to clear chat history. Please try again.');
@@ -1095,25 +3231,44 @@ HTML_TEMPLATE = """
                 const response = await fetch('/delete_chat_entry', {
                     method: 'POST',
                     headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({id: id})
+                    body: JSON.stringify({id: id, page: chatPage, q: document.getElementById('chatSearchInput').value})
                 });
                 if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-                const data = await response.json();
-                document.getElementById('chatHistory').innerHTML = data.html;
-                filterChatHistory();
+                updateChatHistory(await response.json());
             } catch (err) {
                 console.error('Error deleting chat entry:', err);
                 showError('Failed to delete chat entry. Please try again.');
             }
         }
 
+        let chatPage = 1;
+        let chatTotalPages = {{ chat_total_pages }};
+        let chatSearchTimer = null;
+
         function filterChatHistory() {
-            const searchText = document.getElementById('chatSearchInput').value.toLowerCase();
-            const chatEntries = document.querySelectorAll('.chat-entry');
-            chatEntries.forEach(entry => {
-                const query = entry.getAttribute('data-query');
-                entry.style.display = query.includes(searchText) ? 'block' : 'none';
-            });
+            // Searched on the server; wait for a pause in typing
+            clearTimeout(chatSearchTimer);
+            chatSearchTimer = setTimeout(() => loadChatHistory(1), 250);
+        }
+
+        async function loadChatHistory(page) {
+            if (page < 1 || page > chatTotalPages) return;
+            try {
+                const q = encodeURIComponent(document.getElementById('chatSearchInput').value);
+                const response = await fetch(`/chat_history?page=${page}&q=${q}`);
+                if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+                updateChatHistory(await response.json());
+            } catch (err) {
+                console.error('Error loading chat history:', err);
+            }
+        }
+
+        function updateChatHistory(data) {
+            document.getElementById('chatHistory').innerHTML = data.html;
+            chatPage = data.page;
+            chatTotalPages = data.total_pages;
+            document.getElementById('chatPageInfo').textContent = `${chatPage} / ${chatTotalPages}`;
+            document.getElementById('chatPager').style.display = chatTotalPages > 1 ? 'flex' : 'none';
         }
 
         function showLoading(show) {
@@ -1148,6 +3303,200 @@ HTML_TEMPLATE = """
             setTimeout(() => successDiv.remove(), 5000);
         }
 
+        // Result pages arrive as compact arrays and are rendered here; the
+        // server still renders HTML for clients that don't ask for 'data'
+        const TABLE_FORMAT = 'data';
+
+        function showTable(data) {
+            const container = document.getElementById('searchResults');
+            virtualView = null;
+            if (!data.table) {
+                container.innerHTML = data.html;
+                return;
+            }
+            const page = data.table;
+            if (page.message) {
+                const message = document.createElement('p');
+                message.textContent = page.message;
+                container.replaceChildren(message);
+                return;
+            }
+            if (isScrollView()) {
+                startVirtualView(page.columns);
+                return;
+            }
+            const title = document.createElement('h2');
+            title.textContent = 'Search Results';
+            const table = document.createElement('table');
+            const header = table.insertRow();
+            const rowHeader = document.createElement('th');
+            rowHeader.textContent = 'Row #';
+            header.appendChild(rowHeader);
+            page.columns.forEach(column => {
+                const th = document.createElement('th');
+                th.textContent = column;
+                th.addEventListener('click', () => sortColumn(column));
+                header.appendChild(th);
+            });
+            const highlighted = page.highlight.map(rows => new Set(rows));
+            page.row_index.forEach((rowIndex, i) => {
+                const tr = table.insertRow();
+                tr.insertCell().textContent = rowIndex;
+                page.cells.forEach((values, c) => {
+                    const td = tr.insertCell();
+                    td.textContent = values[i];
+                    if (highlighted[c].has(i)) td.className = 'highlight';
+                });
+            });
+            container.replaceChildren(title, table);
+        }
+
+        // Scroll view: rows come from /rows in blocks as they scroll into view and
+        // only the visible ones (plus some overscan) are in the DOM. Spacer rows
+        // above and below keep the scrollbar sized for the whole result.
+        const VIRTUAL_BLOCK_ROWS = 200;
+        const VIRTUAL_OVERSCAN = 20;
+        let virtualView = null;
+        let virtualFrame = null;
+
+        function isScrollView() {
+            return document.getElementById('tableView').value === 'scroll';
+        }
+
+        function changeTableView() {
+            const pagination = document.getElementById('pagination');
+            if (isScrollView()) {
+                pagination.style.display = 'none';
+                updatePagination();
+                startVirtualView(null);
+            } else {
+                virtualView = null;
+                updatePagination();
+                pagination.style.display = totalPages > 1 ? 'flex' : 'none';
+                changePage(Math.min(currentPage, totalPages));
+            }
+        }
+
+        function startVirtualView(columns) {
+            virtualView = {view: null, totalRows: 0, columns: columns, rowHeight: 0, blocks: new Map(), pending: new Set()};
+            document.getElementById('searchResults').scrollTop = 0;
+            loadVirtualBlock(0);
+        }
+
+        async function loadVirtualBlock(block) {
+            const state = virtualView;
+            if (!state || state.blocks.has(block) || state.pending.has(block)) return;
+            state.pending.add(block);
+            const params = new URLSearchParams({start: block * VIRTUAL_BLOCK_ROWS, count: VIRTUAL_BLOCK_ROWS});
+            if (state.view) params.set('view', state.view);
+            try {
+                const response = await fetch(`/rows?${params}`);
+                const data = await response.json();
+                if (state !== virtualView) return;
+                if (response.status === 409) {
+                    // The result changed under us (e.g. an action in another tab)
+                    startVirtualView(null);
+                    return;
+                }
+                if (data.error) throw new Error(data.error);
+                state.view = data.view;
+                state.totalRows = data.total_rows;
+                state.columns = data.table.columns;
+                state.blocks.set(block, {
+                    rowIndex: data.table.row_index,
+                    cells: data.table.cells,
+                    highlighted: data.table.highlight.map(rows => new Set(rows))
+                });
+                if (data.total_pending) {
+                    // Only the first page is known while the search is still
+                    // counting; fetch the block again once more rows may be in
+                    setTimeout(() => {
+                        if (state !== virtualView) return;
+                        state.blocks.delete(block);
+                        loadVirtualBlock(block);
+                    }, 500);
+                }
+                renderVirtualRows();
+            } catch (err) {
+                handleError(err);
+            } finally {
+                state.pending.delete(block);
+            }
+        }
+
+        function scheduleVirtualRender() {
+            if (!virtualView || virtualFrame !== null) return;
+            virtualFrame = requestAnimationFrame(() => {
+                virtualFrame = null;
+                renderVirtualRows();
+            });
+        }
+
+        function renderVirtualRows() {
+            const state = virtualView;
+            if (!state || !state.columns) return;
+            const container = document.getElementById('searchResults');
+            if (!state.totalRows) {
+                const message = document.createElement('p');
+                message.textContent = 'No results found.';
+                container.replaceChildren(message);
+                return;
+            }
+            const rowHeight = state.rowHeight || 40;
+            const first = Math.max(0, Math.floor(container.scrollTop / rowHeight) - VIRTUAL_OVERSCAN);
+            const visible = Math.ceil(container.clientHeight / rowHeight) + 2 * VIRTUAL_OVERSCAN;
+            const last = Math.min(state.totalRows, first + visible);
+            const table = document.createElement('table');
+            table.className = 'virtual-table';
+            const header = table.insertRow();
+            const rowHeader = document.createElement('th');
+            rowHeader.textContent = 'Row #';
+            header.appendChild(rowHeader);
+            state.columns.forEach(column => {
+                const th = document.createElement('th');
+                th.textContent = column;
+                th.addEventListener('click', () => sortColumn(column));
+                header.appendChild(th);
+            });
+            const addSpacer = height => {
+                if (height <= 0) return;
+                const spacer = table.insertRow();
+                spacer.className = 'virtual-spacer';
+                const td = spacer.insertCell();
+                td.colSpan = state.columns.length + 1;
+                td.style.height = `${height}px`;
+            };
+            addSpacer(first * rowHeight);
+            let sampleRow = null;
+            for (let i = first; i < last; i++) {
+                const block = Math.floor(i / VIRTUAL_BLOCK_ROWS);
+                const offset = i % VIRTUAL_BLOCK_ROWS;
+                const rows = state.blocks.get(block);
+                const tr = table.insertRow();
+                if (!rows || offset >= rows.rowIndex.length) {
+                    loadVirtualBlock(block);
+                    tr.insertCell().textContent = '…';
+                    state.columns.forEach(() => { tr.insertCell().textContent = '…'; });
+                    continue;
+                }
+                tr.insertCell().textContent = rows.rowIndex[offset];
+                rows.cells.forEach((values, c) => {
+                    const td = tr.insertCell();
+                    td.textContent = values[offset];
+                    if (rows.highlighted[c].has(offset)) td.className = 'highlight';
+                });
+                sampleRow = sampleRow || tr;
+            }
+            addSpacer((state.totalRows - last) * rowHeight);
+            const scrollTop = container.scrollTop;
+            container.replaceChildren(table);
+            container.scrollTop = scrollTop;
+            if (!state.rowHeight && sampleRow) {
+                state.rowHeight = sampleRow.getBoundingClientRect().height || rowHeight;
+                if (state.rowHeight !== rowHeight) renderVirtualRows();
+            }
+        }
+
         function updateDisplayOptions() {
             const tableWrap = document.getElementById('tableWrap').value;
             const aiWrap = document.getElementById('aiWrap').value;
@@ -1202,15 +3551,14 @@ def index():
         session['rows_per_page'] = persistent_settings.get('rows_per_page', DEFAULT_ROWS_PER_PAGE)
     if 'api_key' not in session:
         session['api_key'] = None
-    if 'chat_history' not in session:
-        session['chat_history'] = persistent_chat_history
 
     current_csv_path = session['csv_path']
     current_model = session['model']
     current_rows_per_page = session['rows_per_page']
     current_api_key = '' if session['api_key'] is None else session['api_key']
     dark_mode = persistent_settings.get('dark_mode', False)
-    chat_history = session['chat_history']
+    compact_strings = persistent_settings.get('compact_strings', False)
+    chat_history, _, chat_total_pages = chat_history_page()
     csv_columns = get_csv_columns(current_csv_path)
 
     success_message = session.pop('success_message', None)
@@ -1223,7 +3571,9 @@ def index():
         current_api_key=current_api_key,
         current_rows_per_page=current_rows_per_page,
         dark_mode=dark_mode,
+        compact_strings=compact_strings,
         chat_history=chat_history,
+        chat_total_pages=chat_total_pages,
         csv_columns=csv_columns,
         success_message=success_message,
         error_message=error_message
@@ -1239,6 +3589,10 @@ def settings():
         filename = f"uploaded_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
         file_path = os.path.join(UPLOAD_FOLDER, filename)
         file.save(file_path)
+        if not get_csv_columns(file_path):
+            os.remove(file_path)
+            session['error_message'] = 'The uploaded CSV file has no header row.'
+            return redirect(url_for('index'))
         session['csv_path'] = file_path
     else:
         session['csv_path'] = session.get('csv_path', DEFAULT_CSV_PATH)
@@ -1254,11 +3608,13 @@ def settings():
     session['rows_per_page'] = rows_per_page
     
     dark_mode = request.form.get('dark_mode', 'false').lower() == 'true'
+    compact_strings = request.form.get('compact_strings', 'false').lower() == 'true'
     persistent_settings.update({
         'csv_path': session['csv_path'],
         'model': session['model'],
         'dark_mode': dark_mode,
-        'rows_per_page': session['rows_per_page']
+        'rows_per_page': session['rows_per_page'],
+        'compact_strings': compact_strings
     })
     save_settings(persistent_settings)
     
@@ -1269,18 +3625,76 @@ def settings():
 def search():
     query = request.json.get('query', '').strip()
     page = request.json.get('page', 1)
+    mode = request.json.get('mode', 'literal')
     csv_path = session.get('csv_path', DEFAULT_CSV_PATH)
     if not query:
         return jsonify({"error": "Search query cannot be empty."})
+    if mode not in SEARCH_MODES:
+        return jsonify({"error": f"Unknown search mode '{mode}'."})
     if not os.path.exists(csv_path):
         return jsonify({"html": "<p style='color:red;'>CSV file not found.</p>", "total_pages": 1})
-    search_results = chunk_search_csv(csv_path, query)
-    if not search_results and not get_csv_columns(csv_path):
+    fast = request.json.get('fast', False) and page == 1 and mode in ('literal', 'regex')
+    try:
+        if fast and cached_search_result(search_cache_key(csv_path, query, mode)) is None:
+            return fast_search(csv_path, query, mode)
+        result_set = search_result_set(csv_path, query, mode)
+    except re.error as e:
+        return jsonify({"error": f"Invalid regular expression: {e}"})
+    if not len(result_set['positions']) and not get_csv_columns(csv_path):
+        return jsonify({"error": "No matching columns found in CSV file."})
+    payload, summary, total_pages = table_payload(result_set, page)
+    session['search_summary'] = summary
+    session['last_query'] = query
+    session['search_mode'] = mode
+    session.pop('view_all', None)
+    pipeline = start_pipeline(csv_path, query, mode, result_set)
+    return jsonify({**payload, "total_pages": total_pages, "steps": pipeline_step_names(pipeline)})
+
+def fast_search(csv_path, query, mode):
+    """Answers /search with page 1 right away and a pending total."""
+    rows_per_page = session.get('rows_per_page', DEFAULT_ROWS_PER_PAGE)
+    # The whole result when the first pass scanned every row, else a prefix of it
+    result_set, job = fast_search_csv(csv_path, query, mode, rows_per_page)
+    if not len(result_set['positions']) and job['status'] == 'done' and not get_csv_columns(csv_path):
         return jsonify({"error": "No matching columns found in CSV file."})
-    html, summary, total_pages = generate_table_html(search_results, page)
+    payload, summary, _ = table_payload(result_set, 1)
+    total_rows, total_pages = search_job_totals(job, rows_per_page)
+    summary['num_rows'] = total_rows
     session['search_summary'] = summary
     session['last_query'] = query
-    return jsonify({"html": html, "total_pages": total_pages})
+    session['search_mode'] = mode
+    session['search_job'] = job['id']
+    session.pop('view_all', None)
+    pipeline = start_pipeline(csv_path, query, mode, result_set, job)
+    return jsonify({
+        **payload,
+        "total_pages": total_pages,
+        "total_rows": total_rows,
+        "total_pending": job['status'] == 'pending',
+        "job_id": job['id'],
+        "steps": pipeline_step_names(pipeline)
+    })
+
+@app.route('/search_status')
+def search_status():
+    """Final (or still approximate) totals of a "first page fast" search."""
+    with state_lock:
+        job = search_jobs.get(request.args.get('job', session.get('search_job', '')))
+    if job is None:
+        return jsonify({"error": "Unknown search job."}), 404
+    rows_per_page = session.get('rows_per_page', DEFAULT_ROWS_PER_PAGE)
+    total_rows, total_pages = search_job_totals(job, rows_per_page)
+    if job['status'] == 'done' and 'search_summary' in session:
+        summary = session['search_summary']
+        summary['num_rows'] = total_rows
+        session['search_summary'] = summary
+    return jsonify({
+        "status": job['status'],
+        "total_rows": total_rows,
+        "total_pages": total_pages,
+        "total_pending": job['status'] == 'pending',
+        "error": job.get('error')
+    })
 
 @app.route('/ai_query', methods=['POST'])
 def ai_query():
@@ -1289,151 +3703,477 @@ def ai_query():
         return jsonify({"error": "AI query cannot be empty."})
     search_summary = session.get('search_summary', {'num_rows': 0, 'sample_rows': [], 'columns': []})
     last_query = session.get('last_query', '')
-    ai_result = get_ai_response(search_summary, user_query, last_query)
-    return jsonify({"ai_html": ai_result['response'], "chat_html": ai_result['chat_html']})
+    if request.json.get('wait'):
+        ai_result = get_ai_response(search_summary, user_query, last_query)
+        return jsonify({"ai_html": ai_result['response'], "chat_html": ai_result['chat_html'],
+                        "chat_total_pages": ai_result.get('chat_total_pages')})
+    job, error = start_ai_job(search_summary, user_query, last_query, use_cache=not request.json.get('refresh'),
+                              batch=bool(request.json.get('batch')))
+    if error is not None:
+        return jsonify({"ai_html": error['response'], "chat_html": error['chat_html']})
+    if job['source'] in ('cache', 'local'):
+        # Answered locally or from the cache: no need to stream
+        result = finish_ai_job(job)
+        return jsonify({"ai_html": result['response'], "chat_html": result['chat_html'],
+                        "chat_total_pages": result.get('chat_total_pages'), "source": job['source']})
+    return jsonify({"job_id": job['id']})
+
+@app.route('/ai_cache_stats')
+def ai_cache_stats():
+    return jsonify(ai_cache_report())
+
+@app.route('/ai_stream')
+def ai_stream():
+    """Streams an AI job's answer as Server-Sent Events while the model writes it."""
+    job = get_ai_job(request.args.get('job', ''))
+    if job is None:
+        return jsonify({'error': 'Unknown or expired AI job'}), 404
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(iter_ai_events(job), mimetype='text/event-stream', headers=headers)
+
+@app.route('/ai_result', methods=['POST'])
+def ai_result():
+    """
+    Final HTML of a finished AI job; also records it in the chat history.
+    409 while the job is still running (the client re-attaches /ai_stream).
+    """
+    job = get_ai_job(request.json.get('job', ''))
+    if job is None:
+        return jsonify({'error': 'Unknown or expired AI job'}), 404
+    result = finish_ai_job(job)
+    if result.get('pending'):
+        return jsonify({'error': 'The AI job is still running', 'status': 'running'}), 409
+    return jsonify({"ai_html": result['response'], "chat_html": result['chat_html'],
+                    "chat_total_pages": result.get('chat_total_pages')})
+
+@app.route('/ai_cancel', methods=['POST'])
+def ai_cancel():
+    job = get_ai_job(request.json.get('job', ''))
+    if job is None:
+        return jsonify({'error': 'Unknown or expired AI job'}), 404
+    cancel_ai_job(job)
+    return jsonify({'status': job['status']})
 
 @app.route('/manipulate_table', methods=['POST'])
 def manipulate_table():
     action = request.json.get('action')
     page = request.json.get('page', 1)
-    query = session.get('last_query', '')
-    if not query:
-        return jsonify({"html": "<p>No search query available to manipulate.</p>", "total_pages": 1})
-    csv_path = session.get('csv_path', DEFAULT_CSV_PATH)
-    if not os.path.exists(csv_path):
+    if not os.path.exists(session.get('csv_path', DEFAULT_CSV_PATH)):
         return jsonify({"html": "<p style='color:red;'>CSV file not found.</p>", "total_pages": 1})
-    search_results = chunk_search_csv(csv_path, query)
-    if not search_results and not get_csv_columns(csv_path):
+    pipeline = current_pipeline()
+    if pipeline is None:
+        return jsonify({"html": "<p>No search query available to manipulate.</p>", "total_pages": 1})
+    if not len(pipeline_result(pipeline)['positions']) and not get_csv_columns(pipeline['csv_path']):
         return jsonify({"error": "No matching columns found in CSV file."})
-    search_results = manipulate_results(search_results, action)
-    html, _, total_pages = generate_table_html(search_results, page)
-    return jsonify({"html": html, "total_pages": total_pages})
+    result_set = append_pipeline_step(pipeline, action)
+    payload, _, total_pages = table_payload(result_set, page)
+    return jsonify({
+        **payload,
+        "total_pages": total_pages,
+        "steps": pipeline_step_names(pipeline),
+        "unsaved_columns": unsaved_columns(result_set)
+    })
+
+@app.route('/persist_columns', methods=['GET', 'POST'])
+def persist_columns():
+    """POST saves derived columns to the CSV in the background; GET reports progress."""
+    csv_path = session.get('csv_path', DEFAULT_CSV_PATH)
+    pipeline = current_pipeline() if csv_path and os.path.exists(csv_path) else None
+    result_set = pipeline_result(pipeline) if pipeline is not None else {}
+    if request.method == 'GET':
+        with csv_cache_lock:
+            status = dict(csv_persist_status)
+        return jsonify(dict(status, unsaved_columns=unsaved_columns(result_set)))
+    if not csv_path or not os.path.exists(csv_path):
+        return jsonify({'error': 'No CSV file selected'}), 400
+    if not unsaved_columns(result_set):
+        return jsonify({'status': 'idle', 'message': 'No unsaved columns'})
+    error = persist_overlay(pipeline['csv_path'], result_set)
+    if error is not None:
+        return jsonify({'error': error}), 409
+    with csv_cache_lock:
+        return jsonify(dict(csv_persist_status))
+
+@app.route('/undo_action', methods=['POST'])
+def undo_action():
+    page = request.json.get('page', 1)
+    pipeline = current_pipeline()
+    if pipeline is None:
+        return jsonify({"html": "<p>No search query available to manipulate.</p>", "total_pages": 1})
+    result_set = undo_pipeline_step(pipeline)
+    payload, _, total_pages = table_payload(result_set, page)
+    return jsonify({
+        **payload,
+        "total_pages": total_pages,
+        "steps": pipeline_step_names(pipeline),
+        "unsaved_columns": unsaved_columns(result_set)
+    })
+
+@app.route('/view_page', methods=['POST'])
+def view_page():
+    """Renders another page of the current pipeline result without re-running it."""
+    page = request.json.get('page', 1)
+    pipeline = current_pipeline()
+    if pipeline is None:
+        return jsonify({"error": "No search query found for pagination."})
+    payload, _, total_pages = table_payload(pipeline_result(pipeline), page)
+    return jsonify({**payload, "total_pages": total_pages, "steps": pipeline_step_names(pipeline)})
+
+@app.route('/rows')
+def rows():
+    """
+    Rows start:start+count of the current result view as compact arrays (see
+    generate_table_data), for the scrolling table. view is the token of a
+    previous response; 409 means the result changed since. While a "first
+    page fast" search is still counting, only the rows found so far are
+    returned, with an approximate total_rows and total_pending set; the
+    client asks again for the rest.
+    """
+    pipeline = current_pipeline(resolve=False)
+    if pipeline is None:
+        return jsonify({"error": "No search query found."}), 404
+    job = pipeline['steps'][0].get('job')
+    pending = job is not None and job['status'] == 'pending'
+    if job is not None and not pending:
+        resolve_pipeline_search(pipeline)
+    view = f"{pipeline['id']}:{pipeline['version']}"
+    if request.args.get('view', view) != view:
+        return jsonify({"error": "The result view has changed.", "view": view}), 409
+    result_set = pipeline_result(pipeline)
+    total_rows = len(result_set['positions'])
+    if pending:
+        total_rows = max(total_rows, search_job_totals(job, session.get('rows_per_page', DEFAULT_ROWS_PER_PAGE))[0])
+    start = min(max(request.args.get('start', 0, type=int), 0), total_rows)
+    count = min(max(request.args.get('count', 100, type=int), 0), MAX_ROW_RANGE)
+    row_indexes, cells, flags = page_cells(result_set, start, start + count)
+    return jsonify({
+        "view": view,
+        "start": start,
+        "total_rows": total_rows,
+        "total_pending": pending,
+        "table": table_arrays(result_set['columns'], row_indexes, cells, flags)
+    })
 
 @app.route('/export', methods=['GET', 'POST'])
 def export_csv():
+    """
+    Streams the current view (the session's pipeline result, or the whole
+    table when there is none) in EXPORT_BATCH_ROWS batches straight from the
+    cached table, so memory stays flat and the download starts at once.
+    ?format= picks csv (default), parquet (one row group per batch), jsonl
+    or xlsx. With ?gzip=1 and a gzip-capable client, csv/jsonl bodies are
+    gzip-encoded.
+    """
     csv_path = session.get('csv_path', DEFAULT_CSV_PATH)
     if not csv_path:
         return jsonify({'error': 'No CSV file selected'}), 400
     if not os.path.exists(csv_path):
         return jsonify({'error': f'CSV file not found at path: {csv_path}'}), 400
-    
-    # Get current search results if available
-    current_results = session.get('search_results', session.get('current_results', []))
-    
-    if current_results:
-        # Export current view including combined columns
-        df = pd.DataFrame([r['data'] for r in current_results])
-        
-        # Apply column selections from session if they exist
-        if 'columns' in session and session['columns']:
-            available_columns = [col for col in session['columns'] if col in df.columns]
-            if available_columns:
-                df = df[available_columns]
-        # Include custom columns if they exist
-        if 'custom_columns' in session and session['custom_columns']:
-            for col_name, col_data in session['custom_columns'].items():
-                if col_name not in df.columns:
-                    df[col_name] = col_data
-        # Ensure original columns are preserved if no custom selections exist
-        elif 'original_columns' in session:
-            df = df[session['original_columns']]
-    else:
-        # Fall back to original CSV if no current results
-        df = load_csv_cached(csv_path)
-        
-        # Apply column selections from session if they exist
-        if 'columns' in session and session['columns']:
-            available_columns = [col for col in session['columns'] if col in df.columns]
-            if available_columns:
-                df = df[available_columns]
-        # Include custom columns if they exist
-        if 'custom_columns' in session and session['custom_columns']:
-            for col_name, col_data in session['custom_columns'].items():
-                if col_name not in df.columns:
-                    df[col_name] = col_data
-        # Ensure original columns are preserved if no custom selections exist
-        elif 'original_columns' in session:
-            df = df[session['original_columns']]
-    
-    if df.empty:
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown export format '{export_format}'"}), 400
+    if export_format == 'parquet' and not HAS_PYARROW:
+        return jsonify({'error': 'Parquet export requires the pyarrow package'}), 400
+    if export_format == 'xlsx' and not HAS_OPENPYXL:
+        return jsonify({'error': 'XLSX export requires the openpyxl package'}), 400
+
+    result_set = export_result_set(csv_path)
+    if not len(result_set['positions']):
         return jsonify({'error': 'No data to export'}), 400
-    
-    # Create output in memory
-    output = io.StringIO()
-    df.to_csv(output, index=False)
-    output.seek(0)
-    
-    return send_file(
-        io.BytesIO(output.getvalue().encode('utf-8')),
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name=f"export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    )
+    if export_format == 'xlsx' and len(result_set['positions']) >= XLSX_MAX_ROWS:
+        return jsonify({'error': f'Too many rows for XLSX (limit {XLSX_MAX_ROWS - 1}); use CSV or Parquet'}), 400
+
+    extension, mimetype, writer = EXPORT_FORMATS[export_format]
+    chunks = writer(result_set)
+    headers = {'Content-Disposition': f"attachment; filename=export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"}
+    if export_format in ('csv', 'jsonl') and request.args.get('gzip') and 'gzip' in request.headers.get('Accept-Encoding', ''):
+        chunks = iter_gzip(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+def export_result_set(csv_path):
+    """The result set /export writes: the current view, else the full table."""
+    pipeline = current_pipeline()
+    if pipeline is not None and pipeline['csv_path'] == csv_path:
+        return pipeline_result(pipeline)
+    df = load_csv_cached(csv_path)
+    result_set = make_result_set(df, np.arange(len(df)))
+    # Apply column selections from session if they exist
+    if 'columns' in session and session['columns']:
+        available_columns = [col for col in session['columns'] if col in df.columns]
+        if available_columns:
+            result_set['columns'] = available_columns
+    return result_set
+
+def iter_csv_batches(result_set, batch_rows=None):
+    """Yields the result set as CSV text, batch_rows rows at a time."""
+    batch_rows = batch_rows or EXPORT_BATCH_ROWS
+    for start in range(0, len(result_set['positions']), batch_rows):
+        frame = result_frame(result_set, start, start + batch_rows)
+        yield frame.to_csv(index=False, header=(start == 0))
+
+def iter_jsonl_batches(result_set, batch_rows=None):
+    """Yields the result set as JSON Lines, one object per row."""
+    batch_rows = batch_rows or EXPORT_BATCH_ROWS
+    for start in range(0, len(result_set['positions']), batch_rows):
+        frame = result_frame(result_set, start, start + batch_rows)
+        text = frame.to_json(orient='records', lines=True, force_ascii=False)
+        yield text if text.endswith('\n') else text + '\n'
+
+class StreamBuffer(io.RawIOBase):
+    """Write-only file object whose written bytes are drained chunk by chunk."""
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_parquet_batches(result_set, batch_rows=None):
+    """Yields a Parquet file, flushing one row group per batch."""
+    batch_rows = batch_rows or EXPORT_BATCH_ROWS
+    sink = StreamBuffer()
+    writer = None
+    for start in range(0, len(result_set['positions']), batch_rows):
+        frame = result_frame(result_set, start, start + batch_rows)
+        table = pyarrow.Table.from_pandas(frame, preserve_index=False, schema=None if writer is None else writer.schema)
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(sink, table.schema)
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+    yield sink.drain()
+
+def iter_xlsx_file(result_set, batch_rows=None):
+    """
+    Yields an XLSX workbook. The zip container is only complete once every
+    row is in, so rows go batch by batch into a write-only workbook in a
+    temporary file, which is then streamed and removed.
+    """
+    batch_rows = batch_rows or EXPORT_BATCH_ROWS
+    temp_path = os.path.join(UPLOAD_FOLDER, f"export_{uuid.uuid4().hex}.xlsx.tmp")
+    try:
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet('Export')
+        sheet.append(result_set['columns'])
+        for start in range(0, len(result_set['positions']), batch_rows):
+            frame = result_frame(result_set, start, start + batch_rows)
+            frame = frame.astype(object).where(frame.notna(), None)
+            for row in frame.itertuples(index=False):
+                sheet.append(list(row))
+        workbook.save(temp_path)
+        with open(temp_path, 'rb') as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                yield data
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def iter_gzip(chunks):
+    """gzip-compresses a stream of text chunks incrementally."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+# Export format -> (file extension, mimetype, chunk generator)
+EXPORT_FORMATS = {
+    'csv': ('csv', 'text/csv', iter_csv_batches),
+    'parquet': ('parquet', 'application/vnd.apache.parquet', iter_parquet_batches),
+    'jsonl': ('jsonl', 'application/x-ndjson', iter_jsonl_batches),
+    'xlsx': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', iter_xlsx_file)
+}
+
+@app.route('/healthz')
+def healthz():
+    """Liveness/readiness probe for load balancers and process managers."""
+    return jsonify({
+        'status': 'ok',
+        'pid': os.getpid(),
+        'uptime_seconds': round(time.time() - SERVER_STARTED, 1),
+        'cached_tables': len(csv_cache),
+        'shared_table_cache': SHARED_TABLE_CACHE and HAS_PYARROW
+    })
+
+@app.route('/profile')
+def column_profile():
+    """Per-column profile of the selected CSV (waits for the profiling pass)."""
+    csv_path = session.get('csv_path', DEFAULT_CSV_PATH)
+    if not csv_path or not os.path.exists(csv_path):
+        return jsonify({'error': 'No CSV file selected'}), 400
+    table_profile = get_table_profile(csv_path)
+    if table_profile is None:
+        return jsonify({'error': 'Profiling failed'}), 500
+    return jsonify(public_profile(table_profile))
+
+@app.route('/memory_usage')
+def memory_usage():
+    csv_path = session.get('csv_path', DEFAULT_CSV_PATH)
+    if not csv_path or not os.path.exists(csv_path):
+        return jsonify({'error': 'No CSV file selected'}), 400
+    load_csv_cached(csv_path)
+    return jsonify(csv_memory_stats)
+
+@app.route('/chat_history')
+def list_chat_history():
+    """One page of the chat history sidebar, optionally filtered by a search over past queries."""
+    page = request.args.get('page', 1, type=int)
+    entries, page, total_pages = chat_history_page(page, request.args.get('q', ''))
+    return jsonify({"html": chat_history_html(entries), "page": page, "total_pages": total_pages})
 
 @app.route('/clear_chat_history')
 def clear_chat_history():
-    session['chat_history'] = []
-    save_chat_history([])
-    return jsonify({"html": ""})
+    clear_chat_entries()
+    return jsonify({"html": "", "page": 1, "total_pages": 1})
 
 @app.route('/delete_chat_entry', methods=['POST'])
 def delete_chat_entry():
-    entry_id = request.json.get('id')
-    chat_history = session.get('chat_history', [])
-    chat_history = [entry for entry in chat_history if entry['id'] != entry_id]
-    session['chat_history'] = chat_history
-    save_chat_history(chat_history)
-    html = ''
-    for entry in chat_history:
-        html += (
-            f'<details class="chat-entry" data-id="{entry["id"]}" data-query="{entry["query"].lower()}">'
-            f'<summary><span>{entry["query"]}</span><button class="delete-chat" onclick="deleteChatEntry({entry["id"]})">Delete</button></summary>'
-            f'<div class="chat-timestamp">{entry["timestamp"]}</div>'
-            f'<p>{entry["response"]}</p>'
-            '</details>'
-        )
-    return jsonify({"html": html})
+    remove_chat_entry(request.json.get('id'))
+    entries, page, total_pages = chat_history_page(request.json.get('page', 1), request.json.get('q', ''))
+    return jsonify({"html": chat_history_html(entries), "page": page, "total_pages": total_pages})
 
 @app.route('/reset')
 def reset():
     session.pop('search_summary', None)
     session.pop('last_query', None)
+    session.pop('search_mode', None)
+    session.pop('search_job', None)
+    session.pop('view_all', None)
+    with state_lock:
+        table_pipelines.pop(session.pop('pipeline_id', None), None)
     return "OK"
 
-def generate_table_html(search_results, page=1):
-    if not search_results:
-        return "<p>No results found.</p>", {'num_rows': 0, 'sample_rows': [], 'columns': []}, 1
+def page_cells(result_set, start, stop):
+    """
+    Rows start:stop column by column: (row indexes, {column: cell strings},
+    {column: bool array flagging matched cells}).
+    """
+    frame = result_frame(result_set, start, stop)
+    match = result_set['match'][start:stop]
+    match_index = {column: j for j, column in enumerate(result_set['match_columns'])}
+    cells = {}
+    flags = {}
+    for column in result_set['columns']:
+        values = frame[column]
+        cells[column] = values.astype(object).where(values.notna(), '').astype(str).tolist()
+        j = match_index.get(column)
+        flags[column] = match[:, j] if j is not None and j < match.shape[1] else np.zeros(len(frame), dtype=bool)
+    return frame.index.tolist(), cells, flags
+
+def table_page(result_set, page):
+    """
+    Shared part of the HTML and data renderers: (message or None, row
+    indexes, cells, flags, summary, total_pages) for one page.
+    """
+    total_rows = len(result_set['positions'])
+    if not total_rows:
+        return "No results found.", [], {}, {}, {'num_rows': 0, 'sample_rows': [], 'columns': []}, 1
     rows_per_page = session.get('rows_per_page', DEFAULT_ROWS_PER_PAGE)
-    total_rows = len(search_results)
     total_pages = (total_rows + rows_per_page - 1) // rows_per_page
     start = (page - 1) * rows_per_page
-    end = start + rows_per_page
-    paginated_results = search_results[start:end]
-    if not paginated_results:
-        return "<p>No results on this page.</p>", {'num_rows': 0, 'sample_rows': [], 'columns': []}, total_pages
-    columns = list(paginated_results[0]['data'].keys())
-    table_html = "<table><tr><th>Row #</th>"
-    for col in columns:
-        table_html += f"<th onclick=\"sortColumn('{col}')\">{col}</th>"
-    table_html += "</tr>"
-    for result in paginated_results:
-        row_index = result['row_index']
-        row_data = result['data']
-        matching_columns = result['matching_columns']
-        table_html += f"<tr><td>{row_index}</td>"
-        for col in columns:
-            cell_val = row_data.get(col, '')
-            highlight = "highlight" if col in matching_columns else ""
-            table_html += f"<td class='{highlight}'>{cell_val}</td>"
-        table_html += "</tr>"
-    table_html += "</table>"
-    sample_rows = [{'row_index': r['row_index'], **r['data']} for r in search_results[:5]]
-    summary = {'num_rows': len(search_results), 'sample_rows': sample_rows, 'columns': columns}
-    return f"<h2>Search Results</h2>{table_html}", summary, total_pages
-    
+    row_indexes, cells, flags = page_cells(result_set, start, start + rows_per_page)
+    if not row_indexes:
+        return "No results on this page.", [], {}, {}, {'num_rows': 0, 'sample_rows': [], 'columns': []}, total_pages
+    sample_rows = [{'row_index': r['row_index'], **r['data']} for r in result_records(result_set, 0, 5)]
+    summary = {'num_rows': total_rows, 'sample_rows': sample_rows, 'columns': result_set['columns']}
+    return None, row_indexes, cells, flags, summary, total_pages
+
+def generate_table_html(result_set, page=1):
+    """One page as an HTML table; cells are built column by column, escaped and joined once."""
+    message, row_indexes, cells, flags, summary, total_pages = table_page(result_set, page)
+    if message is not None:
+        return f"<p>{message}</p>", summary, total_pages
+    columns = result_set['columns']
+    header = ''.join(f'<th onclick="sortColumn({escape(json.dumps(col))})">{escape(col)}</th>' for col in columns)
+    column_cells = [
+        [f"<td class='highlight'>{escape(value)}</td>" if hit else f"<td>{escape(value)}</td>"
+         for value, hit in zip(cells[col], flags[col])]
+        for col in columns
+    ]
+    body = ''.join(
+        f"<tr><td>{row_index}</td>{''.join(row)}</tr>"
+        for row_index, row in zip(row_indexes, zip(*column_cells) if columns else [()] * len(row_indexes))
+    )
+    return f"<h2>Search Results</h2><table><tr><th>Row #</th>{header}</tr>{body}</table>", summary, total_pages
+
+def generate_table_data(result_set, page=1):
+    """
+    One page as compact arrays for the browser to render: the cells column by
+    column, and per column the offsets of highlighted rows.
+    """
+    message, row_indexes, cells, flags, summary, total_pages = table_page(result_set, page)
+    if message is not None:
+        return {'message': message}, summary, total_pages
+    return table_arrays(result_set['columns'], row_indexes, cells, flags), summary, total_pages
+
+def table_arrays(columns, row_indexes, cells, flags):
+    """The compact array form of page_cells output, shared by pages and /rows."""
+    return {
+        'columns': columns,
+        'row_index': row_indexes,
+        'cells': [cells[col] for col in columns],
+        'highlight': [np.flatnonzero(flags[col]).tolist() for col in columns]
+    }
+
+def table_payload(result_set, page=1):
+    """
+    The page in the format the request asked for: {'table': arrays} with
+    format=data, otherwise {'html': markup}; plus summary and total_pages.
+    """
+    options = request.get_json(silent=True) or request.args
+    if options.get('format') == 'data':
+        data, summary, total_pages = generate_table_data(result_set, page)
+        return {'table': data}, summary, total_pages
+    html, summary, total_pages = generate_table_html(result_set, page)
+    return {'html': html}, summary, total_pages
+
+# --- Production Serving ---
+def run_production(host, port, threads):
+    """
+    Serves the app with waitress (threads only, also on Windows) in a single
+    process. Search jobs, AI jobs, pipelines and the save status live in this
+    process's memory, so /search_status, /ai_stream, /ai_result and
+    /persist_columns only work when every request reaches the same process;
+    more processes would need sticky routing or a shared job store.
+    """
+    app.config['DEBUG'] = False
+    try:
+        from waitress import serve
+    except ImportError:
+        sys.exit("Production mode needs waitress (pip install waitress).")
+    serve(app, host=host, port=port, threads=threads)
+
 if __name__ == '__main__':
-    port = int(os.environ.get("PORT", 5000))  # Use PORT env var or default to 5000
-    app.run(host="0.0.0.0", port=port, debug=False)  # Bind to 0.0.0.0 for external access
+    parser = argparse.ArgumentParser(description="CSV Search + AI web app")
+    parser.add_argument('--production', action='store_true', help="serve with a production WSGI server")
+    parser.add_argument('--threads', type=int, default=int(os.environ.get("WEB_THREADS", 8)), help="request threads (production)")
+    parser.add_argument('--host', default="0.0.0.0")
+    parser.add_argument('--port', type=int, default=int(os.environ.get("PORT", 5000)))  # Use PORT env var or default to 5000
+    args = parser.parse_args()
+    if args.production:
+        run_production(args.host, args.port, args.threads)
+    else:
+        app.run(host=args.host, port=args.port, debug=False)  # Bind to 0.0.0.0 for external access
     
 #if __name__ == '__main__':
 #    def run_app():
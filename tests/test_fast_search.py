@@ -0,0 +1,44 @@
+import pandas as pd
+import pytest
+
+import csvsearchai
+
+
+@pytest.fixture
+def client(tmp_path):
+    csv_path = tmp_path / 'people.csv'
+    cities = ['austin', 'boston', 'chicago', 'denver', 'el paso']
+    pd.DataFrame({
+        'name': [f'person {i}' for i in range(3000)],
+        'city': [cities[i % 5] for i in range(3000)]
+    }).to_csv(csv_path, index=False)
+    csvsearchai.app.config['TESTING'] = True
+    client = csvsearchai.app.test_client()
+    with client.session_transaction() as session:
+        session['csv_path'] = str(csv_path)
+        session['rows_per_page'] = 10
+    yield client
+    csvsearchai.clear_csv_cache()
+
+
+def check_full_result(client):
+    # The session's view must hold all 600 matches, not just page 1
+    assert client.post('/view_page', json={'page': 2, 'format': 'data'}).get_json()['table']['row_index']
+    rows = client.get('/rows?start=0&count=1000').get_json()
+    assert rows['total_rows'] == 600
+    assert len(rows['table']['row_index']) == 600
+
+
+def test_fast_search_smaller_than_one_block(client):
+    data = client.post('/search', json={'query': 'austin', 'fast': True, 'format': 'data'}).get_json()
+    assert not data['total_pending']
+    assert data['total_pages'] == 60
+    assert len(data['table']['row_index']) == 10
+    check_full_result(client)
+
+
+def test_fast_search_finished_in_background(client, monkeypatch):
+    monkeypatch.setattr(csvsearchai, 'FAST_SEARCH_BLOCK_ROWS', 500)
+    data = client.post('/search', json={'query': 'austin', 'fast': True, 'format': 'data'}).get_json()
+    assert len(data['table']['row_index']) == 10
+    check_full_result(client)